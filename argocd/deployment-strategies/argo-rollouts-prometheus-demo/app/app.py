@@ -1,9 +1,26 @@
+import os
+
+# SERVER_MODE=gevent serves every request in a greenlet, so the simulated LATENCY
+# (time.sleep) waits without holding an OS thread and concurrent requests all see
+# exactly the configured delay instead of queueing behind each other.
+# Patching has to happen before anything else imports socket, time or threading.
+SERVER_MODE = os.getenv('SERVER_MODE', 'sync')
+if SERVER_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
 from flask import Flask, jsonify, request
-from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
-import random
+from prometheus_client import Counter, Histogram, Gauge, REGISTRY
+from prometheus_client.exposition import choose_encoder, gzip_accepted
 import time
-import os
+import gzip
 import socket
+import hashlib
+import html
+import json
+import threading
+from array import array
+from scenarios import Scenario
 
 app = Flask(__name__)
 
@@ -13,6 +30,28 @@ APP_VERSION = os.getenv('APP_VERSION', 'v1')
 ERROR_RATE = float(os.getenv('ERROR_RATE', '0'))
 # Latency in seconds to add (simulates slow responses)
 LATENCY = float(os.getenv('LATENCY', '0'))
+# Length of the sliding window behind app_success_rate
+SUCCESS_WINDOW_SECONDS = int(os.getenv('SUCCESS_WINDOW_SECONDS', '60'))
+# Seed for the scenario RNG so runs are reproducible, and an optional scenario file applied at startup
+SCENARIO_SEED = os.getenv('SCENARIO_SEED')
+SCENARIO_FILE = os.getenv('SCENARIO_FILE')
+# When set, /admin/scenario requires this value in the X-Admin-Token header
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+# Pending connections the gevent server accepts before the kernel starts refusing them
+LISTEN_BACKLOG = int(os.getenv('LISTEN_BACKLOG', '2048'))
+# Request latency histogram buckets in seconds, e.g. HISTOGRAM_BUCKETS=0.005,0.01,0.05,0.1
+HISTOGRAM_BUCKETS = [float(bucket) for bucket in
+                     os.getenv('HISTOGRAM_BUCKETS', '0.01,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0').split(',')]
+# Probe, scrape, admin and unknown-path requests are timed but not counted, so they don't
+# skew the success rate the canary analysis checks
+UNMATCHED_ENDPOINT = '__unmatched__'
+UNCOUNTED_ENDPOINTS = frozenset(['/health', '/ready', '/metrics', '/admin/scenario', UNMATCHED_ENDPOINT])
+KNOWN_METHODS = frozenset(['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'])
+# Seconds an encoded /metrics response is reused, so scrapes from several Prometheus replicas
+# within that time cost one encode; 0 encodes on every scrape
+METRICS_CACHE_SECONDS = float(os.getenv('METRICS_CACHE_SECONDS', '1'))
+# gzip level for /metrics, 6 gets most of level 9's size at a fraction of its CPU
+METRICS_GZIP_LEVEL = 6
 
 # Prometheus Metrics
 REQUEST_COUNT = Counter(
@@ -25,7 +64,7 @@ REQUEST_LATENCY = Histogram(
     'http_request_duration_seconds',
     'HTTP request latency in seconds',
     ['method', 'endpoint', 'version'],
-    buckets=[0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+    buckets=sorted(HISTOGRAM_BUCKETS)
 )
 
 ERROR_COUNT = Counter(
@@ -36,8 +75,8 @@ ERROR_COUNT = Counter(
 
 SUCCESS_RATE = Gauge(
     'app_success_rate',
-    'Current success rate of the application',
-    ['version']
+    'Share of successful requests over the last SUCCESS_WINDOW_SECONDS',
+    ['endpoint', 'version']
 )
 
 APP_INFO = Gauge(
@@ -46,68 +85,190 @@ APP_INFO = Gauge(
     ['version', 'hostname']
 )
 
-# Set app info on startup
-APP_INFO.labels(version=APP_VERSION, hostname=socket.gethostname()).set(1)
+HOSTNAME = socket.gethostname()
+
+# Set app info once on startup, it doesn't change while running
+APP_INFO.labels(version=APP_VERSION, hostname=HOSTNAME).set(1)
+
+class SuccessWindow:
+    """Requests and successes over the last `seconds` seconds in a ring of per-second buckets.
+
+    Running totals are updated as requests come in and as old seconds expire, so
+    recording and reading are O(1) whatever the traffic; nothing scans the ring.
+    """
+
+    def __init__(self, seconds=SUCCESS_WINDOW_SECONDS):
+        self.seconds = seconds
+        self.requests = array('L', [0]) * seconds
+        self.successes = array('L', [0]) * seconds
+        self.total_requests = 0
+        self.total_successes = 0
+        self.current = int(time.monotonic())
+        self.lock = threading.Lock()
+
+    def advance(self, now):
+        """Clear the buckets of the seconds that left the window (called with the lock held)."""
+        second = int(now)
+        if second <= self.current:
+            return
+        for expired in range(max(self.current + 1, second - self.seconds + 1), second + 1):
+            slot = expired % self.seconds
+            self.total_requests -= self.requests[slot]
+            self.total_successes -= self.successes[slot]
+            self.requests[slot] = self.successes[slot] = 0
+        self.current = second
+
+    def record(self, success):
+        with self.lock:
+            self.advance(time.monotonic())
+            slot = self.current % self.seconds
+            self.requests[slot] += 1
+            self.total_requests += 1
+            if success:
+                self.successes[slot] += 1
+                self.total_successes += 1
+
+    def ratio(self):
+        """Success ratio over the window, NaN when there were no requests."""
+        with self.lock:
+            self.advance(time.monotonic())
+            if not self.total_requests:
+                return float('nan')
+            return self.total_successes / self.total_requests
+
+# Sliding success windows by endpoint, read by app_success_rate when Prometheus scrapes
+success_windows = {}
+success_windows_lock = threading.Lock()
+
+def success_window(endpoint):
+    with success_windows_lock:
+        window = success_windows.get(endpoint)
+        if window is None:
+            window = success_windows[endpoint] = SuccessWindow()
+            SUCCESS_RATE.labels(endpoint=endpoint, version=APP_VERSION).set_function(window.ratio)
+        return window
+
+class MetricsCache:
+    """Encoded exposition per content type, reused for `ttl` seconds.
+
+    Scrapes that miss the cache wait on one lock, so when several arrive together the
+    first encodes the registry and the rest get its output. The gzipped body is made
+    from the cached one the first time a scraper asks for it.
+    """
+
+    def __init__(self, ttl=METRICS_CACHE_SECONDS):
+        self.ttl = ttl
+        # content type -> [encoded at (monotonic), body, gzipped body or None]
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, accept, accept_encoding):
+        """Return (body, content type, whether body is gzipped) for the request's Accept headers."""
+        encoder, content_type = choose_encoder(accept)
+        use_gzip = gzip_accepted(accept_encoding)
+        entry = self.entries.get(content_type)
+        if entry is None or time.monotonic() - entry[0] >= self.ttl or (use_gzip and entry[2] is None):
+            with self.lock:
+                entry = self.entries.get(content_type)
+                now = time.monotonic()
+                if entry is None or now - entry[0] >= self.ttl:
+                    entry = self.entries[content_type] = [now, encoder(REGISTRY), None]
+                if use_gzip and entry[2] is None:
+                    entry[2] = gzip.compress(entry[1], compresslevel=METRICS_GZIP_LEVEL)
+        if use_gzip:
+            return entry[2], content_type, True
+        return entry[1], content_type, False
+
+metrics_cache = MetricsCache()
+
+def request_exemplar(headers):
+    """Exemplar labels linking a latency observation to its trace, from traceparent or X-Request-ID.
+
+    Exemplars are only exposed in the OpenMetrics format.
+    """
+    traceparent = headers.get('traceparent')
+    if traceparent:
+        # version-traceid-parentid-flags
+        parts = traceparent.split('-')
+        if len(parts) == 4 and len(parts[1]) == 32:
+            return {'trace_id': parts[1]}
+    request_id = headers.get('X-Request-ID')
+    if request_id:
+        # Exemplar labels are limited to 128 characters in total
+        return {'request_id': request_id[:100]}
+    return None
+
+def load_scenario():
+    """The scenario from SCENARIO_FILE, or the constant LATENCY and ERROR_RATE from the environment."""
+    if SCENARIO_FILE:
+        with open(SCENARIO_FILE) as f:
+            spec = json.load(f)
+        if SCENARIO_SEED is not None:
+            spec.setdefault('seed', int(SCENARIO_SEED))
+        return Scenario(spec)
+    seed = int(SCENARIO_SEED) if SCENARIO_SEED is not None else None
+    return Scenario.constant(LATENCY, ERROR_RATE, seed)
+
+# Active scenario, replaced as a whole by /admin/scenario so requests never see a half-applied one
+scenario = load_scenario()
+
+# Errors of the simulated failures, bound once since their labels never change
+HOME_ERRORS = ERROR_COUNT.labels(method='GET', endpoint='/', error_type='internal_error', version=APP_VERSION)
+API_DATA_ERRORS = ERROR_COUNT.labels(method='GET', endpoint='/api/data', error_type='internal_error',
+                                     version=APP_VERSION)
+
+# Label children and success window by (endpoint, method, status), created on first use
+# so a request costs a dict lookup instead of a labels() call per metric
+request_children = {}
+
+def bind_request_children(key):
+    endpoint, method, status = key
+    count = window = None
+    if endpoint not in UNCOUNTED_ENDPOINTS:
+        count = REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=status, version=APP_VERSION)
+        window = success_window(endpoint)
+    latency = REQUEST_LATENCY.labels(method=method, endpoint=endpoint, version=APP_VERSION)
+    return request_children.setdefault(key, (count, latency, window, int(status) < 400))
 
 @app.before_request
 def before_request():
-    request.start_time = time.time()
+    request.start_ns = time.perf_counter_ns()
 
 @app.after_request
 def after_request(response):
-    latency = time.time() - request.start_time
-    REQUEST_LATENCY.labels(
-        method=request.method,
-        endpoint=request.path,
-        version=APP_VERSION
-    ).observe(latency)
+    req = request._get_current_object()
+    latency = (time.perf_counter_ns() - req.start_ns) / 1e9
+    # Label by the route template, unknown paths and methods share one series
+    endpoint = req.url_rule.rule if req.url_rule is not None else UNMATCHED_ENDPOINT
+    method = req.method if req.method in KNOWN_METHODS else 'OTHER'
+    key = (endpoint, method, str(response.status_code))
+    count, latency_child, window, success = request_children.get(key) or bind_request_children(key)
+    if count is not None:
+        count.inc()
+        window.record(success)
+    latency_child.observe(latency, request_exemplar(req.headers))
+    # Lets load generators split their results by version when canary and stable share a service
+    response.headers['X-App-Version'] = APP_VERSION
     return response
 
-@app.route('/')
-def home():
-    # Simulate latency
-    if LATENCY > 0:
-        time.sleep(LATENCY)
-
-    # Simulate errors based on ERROR_RATE
-    if random.random() < ERROR_RATE:
-        REQUEST_COUNT.labels(
-            method='GET',
-            endpoint='/',
-            status='500',
-            version=APP_VERSION
-        ).inc()
-        ERROR_COUNT.labels(
-            method='GET',
-            endpoint='/',
-            error_type='internal_error',
-            version=APP_VERSION
-        ).inc()
-        return jsonify({
-            'status': 'error',
-            'message': 'Internal Server Error',
-            'version': APP_VERSION,
-            'hostname': socket.gethostname()
-        }), 500
+def describe_latency(spec):
+    """Short text for a scenario latency spec, e.g. '0.5s' or 'lognormal median=0.05 sigma=0.6'."""
+    kind = spec.get('type', 'constant')
+    if kind == 'constant':
+        return f"{spec.get('value', 0)}s"
+    return ' '.join([kind] + [f'{key}={value}' for key, value in spec.items() if key != 'type'])
 
-    REQUEST_COUNT.labels(
-        method='GET',
-        endpoint='/',
-        status='200',
-        version=APP_VERSION
-    ).inc()
-
-    # Calculate and update success rate
-    success_rate = 1 - ERROR_RATE
-    SUCCESS_RATE.labels(version=APP_VERSION).set(success_rate)
-
-    html = f'''<!DOCTYPE html>
+def render_home_page(scenario):
+    """The home page HTML for a scenario; it only changes when the scenario is replaced."""
+    error_rate = scenario.error_rate('/')
+    varying = ' (before ramps and bursts)' if scenario.ramps or scenario.bursts else ''
+    return f'''<!DOCTYPE html>
 <html>
 <head>
     <title>Rollouts Demo App</title>
     <style>
         body {{
-            background: {'#27ae60' if APP_VERSION == 'v1' else '#e74c3c' if ERROR_RATE > 0.3 else '#3498db'};
+            background: {'#27ae60' if APP_VERSION == 'v1' else '#e74c3c' if error_rate > 0.3 else '#3498db'};
             color: white;
             font-family: Arial, sans-serif;
             text-align: center;
@@ -133,26 +294,67 @@ def home():
     <div class="container">
         <h1>Rollouts Demo Application</h1>
         <h2>Version: {APP_VERSION}</h2>
-        <h3>Hostname: {socket.gethostname()}</h3>
+        <h3>Hostname: {HOSTNAME}</h3>
+
+        <div class="metric">
+            <strong>Scenario:</strong> {html.escape(str(scenario.name))}{varying}
+        </div>
 
         <div class="metric">
-            <strong>Error Rate:</strong> {ERROR_RATE * 100}%
-            <span class="{'unhealthy' if ERROR_RATE > 0.1 else 'healthy'}">
-                {'⚠️ UNHEALTHY' if ERROR_RATE > 0.1 else '✅ HEALTHY'}
+            <strong>Error Rate:</strong> {error_rate * 100}%
+            <span class="{'unhealthy' if error_rate > 0.1 else 'healthy'}">
+                {'⚠️ UNHEALTHY' if error_rate > 0.1 else '✅ HEALTHY'}
             </span>
         </div>
 
         <div class="metric">
-            <strong>Simulated Latency:</strong> {LATENCY}s
+            <strong>Simulated Latency:</strong> {html.escape(describe_latency(scenario.latency_spec('/')))}
         </div>
 
         <div class="metric">
-            <strong>Success Rate:</strong> {(1 - ERROR_RATE) * 100}%
+            <strong>Success Rate:</strong> {(1 - error_rate) * 100}%
         </div>
     </div>
 </body>
 </html>'''
-    return html
+
+def home_page_for(scenario):
+    page = render_home_page(scenario).encode()
+    return page, hashlib.sha1(page).hexdigest()
+
+# (HTML, ETag) of the active scenario, replaced as one value together with the scenario
+home_page = home_page_for(scenario)
+
+def apply_scenario(new):
+    """Make new the active scenario and re-render the home page, which shows its numbers."""
+    global scenario, home_page
+    home_page = home_page_for(new)
+    scenario = new
+
+def home_page_response():
+    """Serve the pre-rendered page; a request with a matching If-None-Match gets a 304."""
+    page, etag = home_page
+    response = app.response_class(page, mimetype='text/html')
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+@app.route('/')
+def home():
+    # Simulate latency and errors from the active scenario
+    delay, fails = scenario.sample('/')
+    if delay > 0:
+        time.sleep(delay)
+
+    if fails:
+        HOME_ERRORS.inc()
+        return jsonify({
+            'status': 'error',
+            'message': 'Internal Server Error',
+            'version': APP_VERSION,
+            'hostname': HOSTNAME
+        }), 500
+
+    return home_page_response()
 
 @app.route('/health')
 def health():
@@ -165,11 +367,12 @@ def health():
 @app.route('/ready')
 def ready():
     """Readiness check - fails if error rate is too high"""
-    if ERROR_RATE > 0.5:
+    error_rate = scenario.error_rate('/')
+    if error_rate > 0.5:
         return jsonify({
             'status': 'not ready',
             'reason': 'error rate too high',
-            'error_rate': ERROR_RATE
+            'error_rate': error_rate
         }), 503
     return jsonify({
         'status': 'ready',
@@ -179,50 +382,64 @@ def ready():
 @app.route('/api/data')
 def api_data():
     """API endpoint that respects error rate"""
-    # Simulate latency
-    if LATENCY > 0:
-        time.sleep(LATENCY)
-
-    # Simulate errors
-    if random.random() < ERROR_RATE:
-        REQUEST_COUNT.labels(
-            method='GET',
-            endpoint='/api/data',
-            status='500',
-            version=APP_VERSION
-        ).inc()
-        ERROR_COUNT.labels(
-            method='GET',
-            endpoint='/api/data',
-            error_type='internal_error',
-            version=APP_VERSION
-        ).inc()
+    # Simulate latency and errors from the active scenario
+    delay, fails = scenario.sample('/api/data')
+    if delay > 0:
+        time.sleep(delay)
+
+    if fails:
+        API_DATA_ERRORS.inc()
         return jsonify({
             'error': 'Failed to fetch data',
             'version': APP_VERSION
         }), 500
 
-    REQUEST_COUNT.labels(
-        method='GET',
-        endpoint='/api/data',
-        status='200',
-        version=APP_VERSION
-    ).inc()
-
     return jsonify({
         'data': 'Sample data from API',
         'version': APP_VERSION,
-        'hostname': socket.gethostname(),
+        'hostname': HOSTNAME,
         'timestamp': time.time()
     }), 200
 
+@app.route('/admin/scenario', methods=['GET', 'PUT', 'DELETE'])
+def admin_scenario():
+    """Show (GET), replace (PUT with a scenario JSON) or reset to the env settings (DELETE) the scenario"""
+    if ADMIN_TOKEN and request.headers.get('X-Admin-Token') != ADMIN_TOKEN:
+        return jsonify({'error': 'invalid admin token'}), 403
+
+    if request.method == 'PUT':
+        try:
+            apply_scenario(Scenario(request.get_json(force=True)))
+        except KeyError as e:
+            return jsonify({'error': f'Invalid scenario: missing {e}'}), 400
+        except (ValueError, TypeError) as e:
+            return jsonify({'error': f'Invalid scenario: {e}'}), 400
+    elif request.method == 'DELETE':
+        apply_scenario(load_scenario())
+    return jsonify(scenario.describe()), 200
+
 @app.route('/metrics')
 def metrics():
-    """Prometheus metrics endpoint"""
-    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+    """Prometheus metrics endpoint, OpenMetrics (with exemplars) and gzip when the scraper asks for them"""
+    body, content_type, gzipped = metrics_cache.get(request.headers.get('Accept'),
+                                                    request.headers.get('Accept-Encoding'))
+    headers = {'Content-Type': content_type, 'Vary': 'Accept, Accept-Encoding'}
+    if gzipped:
+        headers['Content-Encoding'] = 'gzip'
+    return body, 200, headers
 
 if __name__ == '__main__':
     print(f"Starting app version {APP_VERSION}")
     print(f"Error rate: {ERROR_RATE * 100}%")
     print(f"Latency: {LATENCY}s")
-    app.run(host='0.0.0.0', port=8080)
+    print(f"Server mode: {SERVER_MODE}")
+    if SERVER_MODE == 'gevent':
+        from gevent.pywsgi import WSGIServer
+        from gevent.server import StreamServer
+        listener = StreamServer.get_listener(('0.0.0.0', 8080), backlog=LISTEN_BACKLOG, family=socket.AF_INET)
+        # Accepted connections inherit this; without it the small header and body writes on a
+        # keep-alive connection wait ~40ms for the client's delayed ACK (Nagle)
+        listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        WSGIServer(listener, app).serve_forever()
+    else:
+        app.run(host='0.0.0.0', port=8080)
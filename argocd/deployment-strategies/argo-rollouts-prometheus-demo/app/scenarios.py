@@ -0,0 +1,193 @@
+"""Latency and fault scenarios for the rollouts demo app.
+
+A scenario is a JSON document, applied at startup from SCENARIO_FILE or at
+runtime through /admin/scenario:
+
+{
+  "name": "p99-regression",
+  "seed": 42,
+  "default": {"latency": {"type": "constant", "value": 0}, "error_rate": 0},
+  "endpoints": {
+    "/api/data": {"latency": {"type": "lognormal", "median": 0.05, "sigma": 0.6}, "error_rate": 0.01}
+  },
+  "ramps": [
+    {"start": 60, "duration": 120, "latency_scale": [1, 4], "error_rate": [0, 0.05]}
+  ],
+  "bursts": [
+    {"every": 300, "duration": 20, "offset": 30, "error_rate": 0.5, "endpoints": ["/"]}
+  ]
+}
+
+Latency types: constant (value), uniform (min, max), lognormal (median, sigma)
+and pareto (scale = minimum, alpha); any of them can set "max" to cap the tail.
+Ramps and bursts run on the time since the scenario was applied. A ramp moves
+linearly between its [from, to] values over its duration and then holds the last
+value; its error_rate is added to the endpoint's. A burst repeats every "every"
+seconds for "duration" seconds, raising the error rate to at least its own and
+multiplying latency by its latency_scale. Both apply to all endpoints unless
+they list "endpoints".
+
+With a seed, the same sequence of requests gets the same delays and failures.
+"""
+import math
+import random
+import threading
+import time
+
+MAX_LATENCY = 30.0  # seconds, cap on any sampled delay so a heavy tail can't hang a request
+
+
+def latency_sampler(spec):
+    """Turn a latency spec into a function of the RNG returning seconds."""
+    kind = spec.get('type', 'constant')
+    cap = float(spec.get('max', MAX_LATENCY))
+    if kind == 'constant':
+        value = min(float(spec.get('value', 0)), cap)
+        if value < 0:
+            raise ValueError('constant latency must not be negative')
+        return lambda rng: value
+    if kind == 'uniform':
+        low, high = float(spec.get('min', 0)), float(spec['max'])
+        if not 0 <= low <= high:
+            raise ValueError('uniform latency needs 0 <= min <= max')
+        return lambda rng: rng.uniform(low, high)
+    if kind == 'lognormal':
+        median, sigma = float(spec['median']), float(spec.get('sigma', 0.5))
+        if median <= 0 or sigma < 0:
+            raise ValueError('lognormal latency needs median > 0 and sigma >= 0')
+        mu = math.log(median)
+        return lambda rng: min(rng.lognormvariate(mu, sigma), cap)
+    if kind == 'pareto':
+        scale, alpha = float(spec['scale']), float(spec.get('alpha', 2.0))
+        if scale <= 0 or alpha <= 0:
+            raise ValueError('pareto latency needs scale > 0 and alpha > 0')
+        return lambda rng: min(scale * rng.paretovariate(alpha), cap)
+    raise ValueError(f"unknown latency type '{kind}'")
+
+
+def mapping(value, what):
+    """value when it is a JSON object (or missing), ValueError otherwise."""
+    if value is None:
+        return {}
+    if not isinstance(value, dict):
+        raise ValueError(f'{what} must be an object')
+    return value
+
+
+def objects(value, what):
+    """value when it is a list of JSON objects (or missing), ValueError otherwise."""
+    if value is None:
+        return []
+    if not isinstance(value, list) or not all(isinstance(item, dict) for item in value):
+        raise ValueError(f'{what} must be a list of objects')
+    return value
+
+
+def endpoint_set(value, what):
+    """The endpoints a ramp or burst is limited to; a bare string would become a set of its characters."""
+    if value is None:
+        return frozenset()
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise ValueError(f'{what} endpoints must be a list of strings')
+    return frozenset(value)
+
+
+def error_rate(value):
+    value = float(value)
+    if not 0 <= value <= 1:
+        raise ValueError('error_rate must be between 0 and 1')
+    return value
+
+
+def pair(value, default):
+    """A [from, to] pair; a single number means the same value at both ends."""
+    if value is None:
+        return default, default
+    if isinstance(value, (int, float)):
+        return float(value), float(value)
+    start, end = value
+    return float(start), float(end)
+
+
+class Profile:
+    """Latency distribution and error rate of one endpoint."""
+
+    def __init__(self, spec, what='profile'):
+        spec = mapping(spec, what)
+        self.latency_spec = mapping(spec.get('latency'), f'{what} latency')
+        self.latency = latency_sampler(self.latency_spec)
+        self.error_rate = error_rate(spec.get('error_rate', 0))
+
+
+class Scenario:
+    """A parsed scenario; sample() decides the delay and failure of one request."""
+
+    def __init__(self, spec):
+        if not isinstance(spec, dict):
+            raise ValueError('scenario must be a JSON object')
+        self.spec = spec
+        self.name = spec.get('name', 'custom')
+        self.seed = spec.get('seed')
+        self.default = Profile(spec.get('default'), 'default')
+        self.endpoints = {endpoint: Profile(profile, f"endpoint '{endpoint}'")
+                          for endpoint, profile in mapping(spec.get('endpoints'), 'endpoints').items()}
+        self.ramps = []
+        for ramp in objects(spec.get('ramps'), 'ramps'):
+            duration = float(ramp['duration'])
+            if duration <= 0:
+                raise ValueError('ramp duration must be positive')
+            errors = pair(ramp.get('error_rate'), 0.0)
+            for value in errors:
+                error_rate(value)
+            self.ramps.append((float(ramp.get('start', 0)), duration, pair(ramp.get('latency_scale'), 1.0),
+                               errors, endpoint_set(ramp.get('endpoints'), 'ramp')))
+        self.bursts = []
+        for burst in objects(spec.get('bursts'), 'bursts'):
+            every, duration = float(burst['every']), float(burst['duration'])
+            if not 0 < duration <= every:
+                raise ValueError('burst needs 0 < duration <= every')
+            self.bursts.append((every, duration, float(burst.get('offset', 0)),
+                                error_rate(burst.get('error_rate', 0)), float(burst.get('latency_scale', 1)),
+                                endpoint_set(burst.get('endpoints'), 'burst')))
+        self.rng = random.Random(self.seed)
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+
+    @classmethod
+    def constant(cls, latency, rate, seed=None):
+        """The behaviour of the LATENCY and ERROR_RATE environment variables."""
+        return cls({'name': 'env', 'seed': seed,
+                    'default': {'latency': {'type': 'constant', 'value': latency}, 'error_rate': rate}})
+
+    def error_rate(self, endpoint):
+        return self.endpoints.get(endpoint, self.default).error_rate
+
+    def latency_spec(self, endpoint):
+        return self.endpoints.get(endpoint, self.default).latency_spec
+
+    def sample(self, endpoint, now=None):
+        """Return (delay in seconds, whether the request fails) for a request to endpoint."""
+        profile = self.endpoints.get(endpoint, self.default)
+        elapsed = (time.monotonic() if now is None else now) - self.started
+        scale, rate = 1.0, profile.error_rate
+        for start, duration, (scale_from, scale_to), (error_from, error_to), endpoints in self.ramps:
+            if elapsed < start or (endpoints and endpoint not in endpoints):
+                continue
+            progress = min(1.0, (elapsed - start) / duration)
+            scale *= scale_from + (scale_to - scale_from) * progress
+            rate += error_from + (error_to - error_from) * progress
+        for every, duration, offset, burst_rate, burst_scale, endpoints in self.bursts:
+            if elapsed < offset or (endpoints and endpoint not in endpoints):
+                continue
+            if (elapsed - offset) % every < duration:
+                rate = max(rate, burst_rate)
+                scale *= burst_scale
+        # Both draws of a request happen under one lock, so with a seed the same request order replays exactly
+        with self.lock:
+            delay = profile.latency(self.rng) * scale
+            fails = self.rng.random() < rate
+        return min(delay, MAX_LATENCY), fails
+
+    def describe(self):
+        return {'name': self.name, 'seed': self.seed, 'elapsed': round(time.monotonic() - self.started, 1),
+                'spec': self.spec}
@@ -44,6 +44,7 @@ docker buildx build --platform linux/amd64,linux/arm64 \
   --build-arg APP_VERSION=v2 \
   --build-arg ERROR_RATE=0 \
   --build-arg LATENCY=2 \
+  --build-arg SERVER_MODE=gevent \
   -t ${REPO}:v2-slow \
   --push .
 
@@ -54,6 +55,7 @@ docker buildx build --platform linux/amd64,linux/arm64 \
   --build-arg APP_VERSION=v2 \
   --build-arg ERROR_RATE=0.1 \
   --build-arg LATENCY=0.2 \
+  --build-arg SERVER_MODE=gevent \
   -t ${REPO}:v2-flaky \
   --push .
 
@@ -0,0 +1,408 @@
+"""Load generator and canary benchmark for the rollouts demo app (standard library only).
+
+Open loop sends requests at a constant arrival rate whatever the response times,
+and measures latency from when each request was due, so a slow server can't hide
+its queueing (no coordinated omission). Closed loop runs a fixed number of
+clients that each send the next request when the previous one finished.
+
+Latencies go into HDR-style log-linear histograms (< 1% error) per app version,
+taken from the X-App-Version response header, so a run against a service that
+routes to both stable and canary pods reports each version separately.
+
+    # 200 req/s for 60 s against the local app, results saved for later comparison
+    python loadgen.py open --url http://localhost:8080/api/data --rate 200 --duration 60 --output v2.json
+
+    # 50 clients back to back for 30 s
+    python loadgen.py closed --url http://localhost:8080/ --concurrency 50 --duration 30
+
+    # v1 run vs v2 run (or --versions v1 v2 for two versions in one file); exits 1 over the thresholds
+    python loadgen.py compare v1.json v2.json --max-p99-ratio 1.5 --max-error-rate-increase 0.01
+"""
+import argparse
+import asyncio
+import json
+import ssl
+import sys
+from urllib.parse import urlsplit
+
+SUB_BUCKET_BITS = 7          # 128 sub-buckets per power of two, values within 1/128 (< 1%) of the truth
+MAX_MAGNITUDE = 40           # highest power of two tracked, 2**40 microseconds is about 12 days
+PERCENTILES = (50, 90, 99, 99.9)
+UNKNOWN_VERSION = 'unknown'  # responses without X-App-Version and connection errors
+
+
+class LatencyHistogram:
+    """HDR-style histogram of latencies in microseconds.
+
+    Values below 2**SUB_BUCKET_BITS are counted exactly; above that each power of
+    two is split into 2**SUB_BUCKET_BITS linear sub-buckets, so memory is fixed
+    and the relative error stays below 2**-SUB_BUCKET_BITS.
+    """
+
+    def __init__(self):
+        self.counts = [0] * ((MAX_MAGNITUDE + 1) << SUB_BUCKET_BITS)
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def index(value):
+        magnitude = value.bit_length() - 1
+        if magnitude < SUB_BUCKET_BITS:
+            return value
+        shift = magnitude - SUB_BUCKET_BITS
+        return ((shift + 1) << SUB_BUCKET_BITS) + ((value >> shift) & ((1 << SUB_BUCKET_BITS) - 1))
+
+    @staticmethod
+    def value_at(index):
+        """Upper end of the values counted in a bucket."""
+        if index < (1 << SUB_BUCKET_BITS):
+            return index
+        shift = (index >> SUB_BUCKET_BITS) - 1
+        sub_bucket = (index & ((1 << SUB_BUCKET_BITS) - 1)) | (1 << SUB_BUCKET_BITS)
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, seconds):
+        value = min(max(int(seconds * 1e6), 0), (1 << MAX_MAGNITUDE) - 1)
+        self.counts[self.index(value)] += 1
+        self.total += 1
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentiles(self, percentiles=PERCENTILES):
+        """Latency in seconds at each percentile, None when nothing was recorded."""
+        if not self.total:
+            return {p: None for p in percentiles}
+        ranks = sorted((max(1, round(p / 100 * self.total)), p) for p in percentiles)
+        result, seen, position = {}, 0, 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            while position < len(ranks) and seen >= ranks[position][0]:
+                result[ranks[position][1]] = min(self.value_at(index), self.max) / 1e6
+                position += 1
+            if position == len(ranks):
+                break
+        return result
+
+    def to_json(self):
+        return {'counts': {str(index): count for index, count in enumerate(self.counts) if count},
+                'total': self.total, 'max': self.max}
+
+    @classmethod
+    def from_json(cls, data):
+        histogram = cls()
+        for index, count in data['counts'].items():
+            histogram.counts[int(index)] = count
+        histogram.total = data['total']
+        histogram.max = data['max']
+        return histogram
+
+
+class VersionStats:
+    """Requests, errors and latency histogram of one app version."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.status = {}
+        self.latency = LatencyHistogram()
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.errors += other.errors
+        for status, count in other.status.items():
+            self.status[status] = self.status.get(status, 0) + count
+        self.latency.merge(other.latency)
+
+    def error_rate(self):
+        return self.errors / self.requests if self.requests else 0.0
+
+    def to_json(self):
+        return {'requests': self.requests, 'errors': self.errors, 'status': self.status,
+                'latency': self.latency.to_json()}
+
+    @classmethod
+    def from_json(cls, data):
+        stats = cls()
+        stats.requests = data['requests']
+        stats.errors = data['errors']
+        stats.status = data['status']
+        stats.latency = LatencyHistogram.from_json(data['latency'])
+        return stats
+
+
+class HttpClient:
+    """Minimal asyncio HTTP/1.1 client with keep-alive connection reuse per target."""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.idle = {}  # (host, port, tls) -> [(reader, writer)]
+
+    async def connect(self, target):
+        host, port, tls = target
+        return await asyncio.open_connection(host, port, ssl=ssl.create_default_context() if tls else None)
+
+    async def get(self, url):
+        """GET url; returns (status, version header). Raises OSError or TimeoutError on failure."""
+        return await asyncio.wait_for(self.request(url), self.timeout)
+
+    async def request(self, url):
+        parts = urlsplit(url)
+        tls = parts.scheme == 'https'
+        target = (parts.hostname, parts.port or (443 if tls else 80), tls)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        message = f'GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nUser-Agent: rollouts-loadgen\r\n\r\n'.encode()
+
+        idle = self.idle.setdefault(target, [])
+        reused = bool(idle)
+        reader, writer = idle.pop() if idle else await self.connect(target)
+        try:
+            writer.write(message)
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line and reused:
+                # The server closed the idle connection, retry once on a new one
+                writer.close()
+                reader, writer = await self.connect(target)
+                writer.write(message)
+                await writer.drain()
+                status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionError('connection closed before the response')
+            http_version, status = status_line.split()[:2]
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            keep_alive = http_version == b'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+            if 'content-length' in headers:
+                await reader.readexactly(int(headers['content-length']))
+            elif headers.get('transfer-encoding', '').lower() == 'chunked':
+                while True:
+                    size = int((await reader.readline()).split(b';')[0], 16)
+                    await reader.readexactly(size + 2)
+                    if size == 0:
+                        break
+            else:
+                await reader.read()
+                keep_alive = False
+        except BaseException:
+            writer.close()
+            raise
+        if keep_alive:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+        return int(status), headers.get('x-app-version', UNKNOWN_VERSION)
+
+    def close(self):
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+
+
+class LoadRun:
+    """Sends the requests of one run and collects the results by version."""
+
+    def __init__(self, urls, timeout):
+        self.urls = urls
+        self.client = HttpClient(timeout)
+        self.stats = {}
+        self.sent = 0
+        self.dropped = 0
+
+    def version_stats(self, version):
+        stats = self.stats.get(version)
+        if stats is None:
+            stats = self.stats[version] = VersionStats()
+        return stats
+
+    async def one(self, start):
+        """Send one request; latency is measured from `start` (when it was due)."""
+        url = self.urls[self.sent % len(self.urls)]
+        self.sent += 1
+        loop = asyncio.get_running_loop()
+        try:
+            status, version = await self.client.get(url)
+        except (OSError, asyncio.TimeoutError, ValueError, asyncio.IncompleteReadError):
+            stats = self.version_stats(UNKNOWN_VERSION)
+            stats.requests += 1
+            stats.errors += 1
+            stats.status['error'] = stats.status.get('error', 0) + 1
+            return
+        stats = self.version_stats(version)
+        stats.requests += 1
+        stats.status[str(status)] = stats.status.get(str(status), 0) + 1
+        if status >= 500:
+            stats.errors += 1
+        stats.latency.record(loop.time() - start)
+
+    async def open_loop(self, rate, duration, max_inflight):
+        """Start a request every 1/rate seconds, dropping (and counting) any beyond max_inflight."""
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        in_flight = set()
+        for sequence in range(int(rate * duration)):
+            due = start + sequence / rate
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if len(in_flight) >= max_inflight:
+                self.dropped += 1
+                continue
+            task = asyncio.ensure_future(self.one(due))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        if in_flight:
+            await asyncio.wait(in_flight)
+        return loop.time() - start
+
+    async def closed_loop(self, concurrency, duration, think_time):
+        """Run `concurrency` clients that each send their next request when the last one is done."""
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = start + duration
+
+        async def client():
+            while loop.time() < deadline:
+                await self.one(loop.time())
+                if think_time:
+                    await asyncio.sleep(think_time)
+
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return loop.time() - start
+
+
+def format_ms(seconds):
+    return f'{seconds * 1000:9.2f}' if seconds is not None else '        -'
+
+
+def print_table(rows):
+    """rows: (label, VersionStats) pairs."""
+    print(f"{'version':<12} {'requests':>9} {'errors':>7} {'err %':>7} "
+          + ' '.join(f"{'p' + str(p) + ' ms':>9}" for p in PERCENTILES) + f" {'max ms':>9}")
+    for label, stats in rows:
+        percentiles = stats.latency.percentiles()
+        print(f'{label:<12} {stats.requests:>9} {stats.errors:>7} {stats.error_rate() * 100:>7.2f} '
+              + ' '.join(format_ms(percentiles[p]) for p in PERCENTILES)
+              + f' {format_ms(stats.latency.max / 1e6 if stats.latency.total else None)}')
+
+
+def run(args):
+    load = LoadRun(args.url, args.timeout)
+
+    async def main():
+        try:
+            if args.mode == 'open':
+                return await load.open_loop(args.rate, args.duration, args.max_inflight)
+            return await load.closed_loop(args.concurrency, args.duration, args.think_time)
+        finally:
+            load.client.close()
+
+    elapsed = asyncio.run(main())
+    print(f'{args.mode} loop: {load.sent} requests in {elapsed:.1f}s ({load.sent / elapsed:.1f} req/s)'
+          + (f', {load.dropped} dropped over --max-inflight' if load.dropped else ''))
+    print_table(sorted(load.stats.items()))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'mode': args.mode, 'urls': args.url, 'duration': elapsed, 'dropped': load.dropped,
+                       'versions': {version: stats.to_json() for version, stats in load.stats.items()}}, f)
+        print(f'results written to {args.output}')
+    return 0
+
+
+def load_results(path, versions=None):
+    """All versions of a results file merged into one VersionStats (or only the given versions)."""
+    with open(path) as f:
+        data = json.load(f)
+    merged = VersionStats()
+    for version, stats in data['versions'].items():
+        if versions is None or version in versions:
+            merged.merge(VersionStats.from_json(stats))
+    return merged
+
+
+def compare(args):
+    if args.versions:
+        if len(args.files) != 1:
+            print('--versions compares two versions within one results file', file=sys.stderr)
+            return 2
+        baseline_label, candidate_label = args.versions
+        baseline = load_results(args.files[0], {baseline_label})
+        candidate = load_results(args.files[0], {candidate_label})
+    else:
+        if len(args.files) != 2:
+            print('compare needs a baseline and a candidate results file', file=sys.stderr)
+            return 2
+        baseline_label, candidate_label = 'baseline', 'candidate'
+        baseline = load_results(args.files[0])
+        candidate = load_results(args.files[1])
+
+    print_table([(baseline_label, baseline), (candidate_label, candidate)])
+    base_percentiles = baseline.latency.percentiles()
+    candidate_percentiles = candidate.latency.percentiles()
+    # A side without traffic would pass every threshold, so it fails the comparison instead
+    empty = [label for label, stats, percentiles in ((baseline_label, baseline, base_percentiles),
+                                                     (candidate_label, candidate, candidate_percentiles))
+             if not stats.requests or percentiles[99] is None]
+    if empty:
+        print(f"no requests or latencies for {' and '.join(empty)}, nothing to compare", file=sys.stderr)
+        return 2
+    ratios = {p: candidate_percentiles[p] / base_percentiles[p]
+              for p in PERCENTILES if base_percentiles[p] and candidate_percentiles[p] is not None}
+    print(f"{'ratio':<12} {'':>9} {'':>7} {'':>7} "
+          + ' '.join(f'{ratios[p]:>8.2f}x' if p in ratios else '        -' for p in PERCENTILES))
+    error_increase = candidate.error_rate() - baseline.error_rate()
+    print(f'error rate change: {error_increase * 100:+.2f} percentage points')
+
+    failures = []
+    if args.max_p99_ratio is not None and ratios.get(99, 0) > args.max_p99_ratio:
+        failures.append(f'p99 ratio {ratios[99]:.2f} > {args.max_p99_ratio}')
+    if args.max_error_rate_increase is not None and error_increase > args.max_error_rate_increase:
+        failures.append(f'error rate increase {error_increase:.4f} > {args.max_error_rate_increase}')
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    return 1 if failures else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load generator and canary comparison for the rollouts demo app')
+    modes = parser.add_subparsers(dest='mode', required=True)
+
+    for mode, help_text in (('open', 'constant arrival rate'), ('closed', 'fixed number of clients')):
+        sub = modes.add_parser(mode, help=help_text)
+        sub.add_argument('--url', action='append', required=True,
+                         help='target url, repeat to spread requests round robin')
+        sub.add_argument('--duration', type=float, default=30, help='seconds to run (default 30)')
+        sub.add_argument('--timeout', type=float, default=10, help='per-request timeout in seconds (default 10)')
+        sub.add_argument('--output', help='write the results as JSON for compare')
+        if mode == 'open':
+            sub.add_argument('--rate', type=float, required=True, help='requests per second')
+            sub.add_argument('--max-inflight', type=int, default=10000,
+                             help='requests in flight before new ones are dropped (default 10000)')
+        else:
+            sub.add_argument('--concurrency', type=int, default=10, help='clients (default 10)')
+            sub.add_argument('--think-time', type=float, default=0, help='seconds between requests of a client')
+
+    sub = modes.add_parser('compare', help='compare two runs, or two versions of one run')
+    sub.add_argument('files', nargs='+', help='baseline and candidate results, or one file with --versions')
+    sub.add_argument('--versions', nargs=2, metavar=('BASELINE', 'CANDIDATE'))
+    sub.add_argument('--max-p99-ratio', type=float, help='fail when candidate p99 / baseline p99 is above this')
+    sub.add_argument('--max-error-rate-increase', type=float,
+                     help='fail when the error rate grows by more than this (0.01 = 1 point)')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    sys.exit(compare(arguments) if arguments.mode == 'compare' else run(arguments))
@@ -1,26 +1,29 @@
-from flask import Flask, request
-from prometheus_client import Counter, start_http_server, make_wsgi_app, Histogram, Summary, Gauge
+from flask import Flask, request, jsonify
+from prometheus_client import start_http_server, Gauge
+from prometheus_client.core import GaugeMetricFamily
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
-import time
+from request_metrics import RequestMetrics, metrics_wsgi_app
+from array import array
+import collections
+import hashlib
+import heapq
+import os
+import threading
 
 app = Flask(__name__)
-app.wsgi_app =DispatcherMiddleware(app.wsgi_app, {'/metrics': make_wsgi_app()})
-REQUESTS = Counter('http_requests_total','Total number of requests',labelnames=['path','method'])
-#LATENCY = Histogram('request_latency_seconds','Request Latency', labelnames=['path','method'])
-LATENCY = Summary('request_latency_seconds','FlaskRequest Latency', labelnames=['path','method'])
-IN_PROGRESS = Gauge('inprogress_requests','Total number of requests in progress',labelnames=['path','method'])
 
-def before_request():
-    request.start_time = time.time()
-
-def after_request(response):
-    request_latency = time.time() - request.start_time 
-    LATENCY.labels(request.method,request.path).observe(request_latency)
-    IN_PROGRESS.labels(request.method,request.path).dec()
-    return response
+# Frequency tracking across all /update_strings calls, memory is fixed by these sizes
+CMS_WIDTH = int(os.getenv('CMS_WIDTH', '2048'))        # counters per row, error ~ 2.7 * total / width
+CMS_DEPTH = int(os.getenv('CMS_DEPTH', '4'))           # rows, error bound holds with probability 1 - e**-depth
+TOP_K_CAPACITY = int(os.getenv('TOP_K_CAPACITY', '100'))  # strings tracked by the top-K summary
+TOP_K_GAUGES = int(os.getenv('TOP_K_GAUGES', '10'))    # top strings exported as labeled gauges
+LABEL_MAX_LENGTH = 100                                 # longer strings are cut in gauge labels
+# Request count, latency and in-progress metrics for every route, labelled by route template
+request_metrics = RequestMetrics(app)
 
 # Define a Gauge metric for unique string count
-UNIQUE_STRING_COUNT = Gauge('unique_string_count', 'Number of unique strings in the provided list')
+UNIQUE_STRING_COUNT = Gauge('unique_string_count', 'Number of unique strings in the provided list',
+                            multiprocess_mode='livemostrecent')
 
 # Global variable to store the current list of strings
 current_strings = []
@@ -30,6 +33,128 @@ def update_unique_string_count(strings):
     unique_strings = set(strings)  # Use a set to find unique strings
     UNIQUE_STRING_COUNT.set(len(unique_strings))  # Set the metric value
 
+class CountMinSketch:
+    """Approximate per-string counts in a fixed depth x width table.
+
+    An estimate is never below the true count and exceeds it by at most
+    e/width of all counted strings with probability 1 - e**-depth.
+    """
+
+    def __init__(self, width=CMS_WIDTH, depth=CMS_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.table = array('Q', [0]) * (width * depth)
+        self.total = 0
+
+    def indexes(self, value):
+        # Two 64-bit hashes combined give the depth row hashes (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, value, count=1):
+        """Add count occurrences of value and return its new estimate."""
+        self.total += count
+        estimate = None
+        for index in self.indexes(value):
+            self.table[index] += count
+            if estimate is None or self.table[index] < estimate:
+                estimate = self.table[index]
+        return estimate
+
+    def estimate(self, value):
+        return min(self.table[index] for index in self.indexes(value))
+
+class SpaceSaving:
+    """Space-Saving summary of the most frequent strings, holding at most capacity of them.
+
+    A new string replaces the least counted one and inherits its count as
+    possible error, so the summary always holds every string that occurs
+    more than total / capacity times. Counts are kept in a dict and the
+    minimum is found through a heap whose outdated entries are skipped.
+    """
+
+    def __init__(self, capacity=TOP_K_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}  # string -> [count, error]
+        self.heap = []    # (count, string), may hold outdated entries
+
+    def add(self, value, count=1, upper_bound=None):
+        """Count value; upper_bound (e.g. a Count-Min estimate) caps the count a new string inherits."""
+        entry = self.counts.get(value)
+        if entry is not None:
+            entry[0] += count
+        elif len(self.counts) < self.capacity:
+            entry = self.counts[value] = [count, 0]
+        else:
+            evicted_count, evicted = self.pop_min()
+            new_count = evicted_count + count
+            if upper_bound is not None and upper_bound < new_count:
+                new_count = upper_bound
+            entry = self.counts[value] = [new_count, new_count - count]
+        heapq.heappush(self.heap, (entry[0], value))
+        if len(self.heap) > 2 * self.capacity + 64:
+            # Drop outdated heap entries so memory stays bounded by the capacity
+            self.heap = [(entry[0], value) for value, entry in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def pop_min(self):
+        while True:
+            count, value = heapq.heappop(self.heap)
+            entry = self.counts.get(value)
+            if entry is not None and entry[0] == count:
+                del self.counts[value]
+                return count, value
+
+    def top(self, k):
+        """The k most counted strings as (string, count, error), most frequent first."""
+        return [(value, entry[0], entry[1])
+                for value, entry in heapq.nlargest(k, self.counts.items(), key=lambda item: item[1][0])]
+
+class FrequencyTracker:
+    """Count-Min Sketch for any string's frequency plus a Space-Saving top-K, safe across threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sketch = CountMinSketch()
+        self.top_k = SpaceSaving()
+
+    def add_many(self, strings):
+        # Count duplicates within one post first so each distinct string is hashed once
+        with self.lock:
+            for value, count in collections.Counter(strings).items():
+                estimate = self.sketch.add(value, count)
+                self.top_k.add(value, count, estimate)
+
+    def top(self, k):
+        with self.lock:
+            return self.top_k.top(k), self.sketch.total
+
+    def estimate(self, value):
+        with self.lock:
+            return self.sketch.estimate(value)
+
+frequencies = FrequencyTracker()
+
+class TopStringsCollector:
+    """top_string_count of the TOP_K_GAUGES most frequent strings, read from frequencies on every scrape.
+
+    Nothing has to be removed when a string leaves the top, so there are never
+    more than TOP_K_GAUGES series, also in multiprocess mode where a Gauge's
+    series can't be removed from the shared files. The counts are this process's.
+    """
+
+    def collect(self):
+        family = GaugeMetricFamily('top_string_count', 'Estimated count of the most frequent strings across all posts',
+                                   labels=['rank', 'string'])
+        top, _ = frequencies.top(TOP_K_GAUGES)
+        for rank, (value, count, _) in enumerate(top, 1):
+            family.add_metric([str(rank), value[:LABEL_MAX_LENGTH]], count)
+        yield family
+
+app.wsgi_app =DispatcherMiddleware(app.wsgi_app, {'/metrics': metrics_wsgi_app([TopStringsCollector()])})
+
 @app.route('/update_strings', methods=['POST'])
 def update_strings():
     global current_strings
@@ -42,33 +167,52 @@ def update_strings():
 
     current_strings = data['strings']
     update_unique_string_count(current_strings)
+    frequencies.add_many(str(value) for value in current_strings)
     return jsonify({'message': f'Unique string count updated based on the provided list'}), 200
 
+@app.route('/top', methods=['GET'])
+def top_strings():
+    """Most frequent strings across all posts. count is an upper bound, count - error a lower bound."""
+    try:
+        k = int(request.args.get('k', 10))
+    except ValueError:
+        return jsonify({'error': 'k must be an integer'}), 400
+    if not 1 <= k <= TOP_K_CAPACITY:
+        return jsonify({'error': f'k must be between 1 and {TOP_K_CAPACITY}'}), 400
+
+    top, total = frequencies.top(k)
+    return jsonify({
+        'total': total,
+        'top': [{'string': value, 'count': count, 'error': error} for value, count, error in top]
+    }), 200
+
+@app.route('/frequency', methods=['GET'])
+def string_frequency():
+    """Count-Min estimate of how often a string was posted, never below the true count."""
+    value = request.args.get('string')
+    if value is None:
+        return jsonify({'error': 'string is required'}), 400
+    return jsonify({'string': value, 'estimate': frequencies.estimate(value)}), 200
+
 @app.get("/cars")
 def get_cards():
-    REQUESTS.labels('/cars','get').inc()
     #time.sleep(33)
     return ["toyota", "honda", "mazda" ,"lexus"]
 
 @app.post("/cars")
 def create_cars():
-    REQUESTS.labels('/cars','post').inc()
     #time.sleep(23)
     return "Create Car"
 
 @app.get("/boats")
 def get_boats():
-    REQUESTS.labels('/boats','get').inc()
     #time.sleep(65)
     return ["boat1","boat2","boat3"]
 
 @app.post("/boats")
 def create_boat():
-    REQUESTS.labels('/boats','post').inc()
     return "Create Boat"
 
 if __name__ == '__main__':  
     start_http_server(8000)
-    app.before_request(before_request)
-    app.after_request(after_request)    
     app.run(host="0.0.0.0",port=5000)
@@ -0,0 +1,36 @@
+# gunicorn settings for running the app with several worker processes:
+#   gunicorn -c gunicorn.conf.py find-unique-strings-flask:app
+# Each worker writes its metrics to PROMETHEUS_MULTIPROC_DIR and /metrics adds them up.
+import glob
+import multiprocessing
+import os
+
+# Must be set before prometheus_client is imported, here and in the workers, it is read on import
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus-multiproc')
+
+from prometheus_client import multiprocess
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+# The string counts behind /update_strings, /top, /frequency and top_string_count live in
+# each worker, so one worker with threads is the default. More workers still report correct
+# /metrics totals for the request metrics, but each then only sees the posts it received.
+workers = int(os.getenv('GUNICORN_WORKERS', '1'))
+threads = int(os.getenv('GUNICORN_THREADS', str(multiprocessing.cpu_count() * 2)))
+accesslog = '-'
+
+
+def on_starting(server):
+    """Remove the metric files of a previous run so they aren't counted again.
+
+    Only prometheus_client's *.db files are deleted, the directory and anything
+    else in it are left alone.
+    """
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, '*.db')):
+        os.remove(path)
+
+
+def child_exit(server, worker):
+    """Drop the live gauges of a dead worker; its counters stay so totals don't go backwards."""
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,156 @@
+"""Request metrics for Flask apps, labelled by route template with a cap on series.
+
+Usage:
+    from request_metrics import RequestMetrics
+    RequestMetrics(app)
+
+Requests are labelled with the matched route (e.g. '/cars/<int:car_id>') instead of
+the raw path, so ids in URLs and scanners hitting random paths can't create new
+time series. Each metric also has a hard cap on label sets; once it is reached new
+label sets are counted under path='__overflow__'.
+
+The label children of every (route, method, status) are created once and kept, so
+a request costs two perf_counter_ns() calls, a dict lookup and the metric updates
+instead of a labels() lookup per metric. Latency is a Histogram, which unlike a
+Summary can be aggregated across instances with histogram_quantile(). Its buckets
+come from REQUEST_LATENCY_BUCKETS (comma separated seconds) or the buckets argument.
+
+metrics_wsgi_app() serves /metrics. When the app runs under gunicorn with
+PROMETHEUS_MULTIPROC_DIR set (see gunicorn.conf.py) every worker writes its
+metrics to mmap files in that directory and /metrics reports the totals of all
+workers, whichever worker answers the scrape.
+"""
+import os
+import threading
+import time
+
+from flask import request
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, make_wsgi_app, multiprocess
+
+MAX_SERIES = 500                      # label sets per metric before new ones go to the overflow bucket
+UNMATCHED_PATH = '__unmatched__'      # requests that matched no route (404s, scanners)
+OVERFLOW_PATH = '__overflow__'        # requests over the series cap
+# 'method' label values; lowercase like the apps' old http_requests_total, other methods share 'other'
+METHOD_LABELS = {method: method.lower() for method in ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS')}
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MULTIPROCESS = 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+
+
+def metrics_wsgi_app(collectors=()):
+    """WSGI app for /metrics, aggregating all workers' metrics in multiprocess mode.
+
+    collectors are custom collectors that report this process's own state; they
+    are served as they are, next to the aggregated metrics in multiprocess mode.
+    """
+    if not MULTIPROCESS:
+        for collector in collectors:
+            REGISTRY.register(collector)
+        return make_wsgi_app()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    for collector in collectors:
+        registry.register(collector)
+    return make_wsgi_app(registry)
+
+
+def latency_buckets():
+    """Histogram buckets from REQUEST_LATENCY_BUCKETS, or DEFAULT_BUCKETS when it isn't set."""
+    value = os.getenv('REQUEST_LATENCY_BUCKETS')
+    if not value:
+        return DEFAULT_BUCKETS
+    return tuple(sorted(float(bucket) for bucket in value.split(',')))
+
+
+class RequestMetrics:
+    """Counts, times and tracks in-flight requests of a Flask app.
+
+    The metrics keep the names and 'path'/'method' labels the apps in this repo
+    already use, with the method in lowercase ('get', 'post') as the old
+    http_requests_total had it, so selectors like method="get" keep matching.
+    Requests and latency are also labelled with the response 'status'. The old
+    latency and in-progress metrics had the path and method values swapped;
+    those now have the path in 'path' and the method in 'method'.
+    """
+
+    def __init__(self, app=None, max_series=MAX_SERIES, buckets=None, registry=None):
+        kwargs = {'registry': registry} if registry is not None else {}
+        self.requests = Counter('http_requests_total', 'Total number of requests',
+                                labelnames=['path', 'method', 'status'], **kwargs)
+        self.latency = Histogram('request_latency_seconds', 'FlaskRequest Latency',
+                                 labelnames=['path', 'method', 'status'],
+                                 buckets=buckets or latency_buckets(), **kwargs)
+        self.in_progress = Gauge('inprogress_requests', 'Total number of requests in progress',
+                                 labelnames=['path', 'method'], multiprocess_mode='livesum', **kwargs)
+        self.overflow = Counter('metric_series_overflow_total',
+                                'Requests counted in the overflow bucket because a metric hit its series cap',
+                                labelnames=['metric'], **kwargs)
+        self.max_series = max_series
+        # (path, method, status) -> (requests child, latency child), (path, method) -> in-progress child
+        self.children = {}
+        self.in_progress_children = {}
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        # teardown runs even when the view raised, so the in-progress gauge always goes back down
+        app.teardown_request(self.teardown_request)
+
+    def bind_in_progress(self, key):
+        """Create (or reuse) the in-progress child of a (path, method), within the series cap."""
+        with self.lock:
+            child = self.in_progress_children.get(key)
+            if child is not None:
+                return child
+            if len(self.in_progress_children) < self.max_series:
+                child = self.in_progress_children[key] = self.in_progress.labels(*key)
+                return child
+        # Over the cap: not cached, so every such request takes this path
+        self.overflow.labels('inprogress_requests').inc()
+        return self.in_progress.labels(OVERFLOW_PATH, key[1])
+
+    def bind(self, key):
+        """Create (or reuse) the requests and latency children of a (path, method, status)."""
+        with self.lock:
+            children = self.children.get(key)
+            if children is not None:
+                return children
+            if len(self.children) < self.max_series:
+                children = self.children[key] = (self.requests.labels(*key), self.latency.labels(*key))
+                return children
+        self.overflow.labels('http_requests_total').inc()
+        self.overflow.labels('request_latency_seconds').inc()
+        overflow_key = (OVERFLOW_PATH,) + key[1:]
+        return self.requests.labels(*overflow_key), self.latency.labels(*overflow_key)
+
+    # Each hook resolves the request proxy once, every access through it costs a context lookup
+
+    def before_request(self):
+        req = request._get_current_object()
+        rule = req.url_rule
+        key = (rule.rule if rule is not None else UNMATCHED_PATH, METHOD_LABELS.get(req.method, 'other'))
+        child = self.in_progress_children.get(key) or self.bind_in_progress(key)
+        child.inc()
+        # status is filled in by after_request; it stays 500 when the view raised
+        req.metrics_state = [key, child, '500', time.perf_counter_ns()]
+
+    def after_request(self, response):
+        state = getattr(request._get_current_object(), 'metrics_state', None)
+        if state is not None:
+            state[2] = str(response.status_code)
+        return response
+
+    def teardown_request(self, exc=None):
+        end_ns = time.perf_counter_ns()
+        state = getattr(request._get_current_object(), 'metrics_state', None)
+        if state is None:
+            # before_request never ran, e.g. another before_request handler failed first
+            return
+        key, in_progress_child, status, start_ns = state
+        key = key + (status,)
+        requests_child, latency_child = self.children.get(key) or self.bind(key)
+        requests_child.inc()
+        latency_child.observe((end_ns - start_ns) / 1e9)
+        in_progress_child.dec()
@@ -1,201 +1,1226 @@
 import requests
+import socket
 import json
+import os
+import queue
+import atexit
+import base64
+import hashlib
+import math
+import signal
+import weakref
 import time
+import heapq
+import itertools
+import random
+import re
 import logging
+import logging.handlers
 import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
 from flask import Flask, request, jsonify
-from prometheus_client import Counter, start_http_server, make_wsgi_app, Histogram, Summary, Gauge
+from prometheus_client import Counter, Histogram, Gauge
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from request_metrics import MULTIPROCESS, RequestMetrics, metrics_wsgi_app
+
+# orjson is much faster than json for the many small log records; fall back to json if it's missing
+try:
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=str).decode()
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj, default=str, separators=(',', ':'))
 
 app = Flask(__name__)
 
-# Global variables
-monitoring_thread = None
-stop_logging = False
-app.wsgi_app =DispatcherMiddleware(app.wsgi_app, {'/metrics': make_wsgi_app()})
-REQUESTS = Counter('http_requests_total','Total number of requests',labelnames=['path','method'])
-LATENCY = Summary('request_latency_seconds','FlaskRequest Latency', labelnames=['path','method'])
-IN_PROGRESS = Gauge('inprogress_requests','Total number of requests in progress',labelnames=['path','method'])
+# Defaults for website checks, all can be overridden in the /start_logging request
+DEFAULT_MAX_CONCURRENCY = 100   # checks running at the same time
+DEFAULT_CHECK_TIMEOUT = 10      # read timeout in seconds before a slow site counts as a connection error
+DEFAULT_CONNECT_TIMEOUT = 5     # seconds to establish the TCP connection
+DEFAULT_MAX_BYTES = 1024 * 1024 # stop reading a page after this many bytes (per site 'max_bytes')
+CHECK_CHUNK_SIZE = 16 * 1024    # bytes read from the response per iteration
+REGEX_WINDOW = 4096             # longest regex match guaranteed to be found across a chunk boundary
+DRAIN_LIMIT = 64 * 1024         # after an early match, read up to this much more to keep the connection
+DNS_LOOKUP_THREADS = 32         # DNS lookups of new check connections running at the same time
+CONFIG_POLL_INTERVAL = 5        # seconds between checks of the config file's modification time
+SHUTDOWN_TIMEOUT = 1            # seconds /stop_logging and SIGTERM wait for the checker thread to stop
+
+# Log file settings, set through environment variables
+LOG_FILE = os.getenv('LOG_FILE', 'monitor.log')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(50 * 1024 * 1024)))  # rotate by size ...
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', '')  # ... or by time instead, e.g. 'midnight' or 'H'
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))  # records waiting for the writer thread
+
+# Writer thread that owns the log handlers, started once by setup_logging()
+log_listener = None
+log_setup_lock = threading.Lock()
+
+app.wsgi_app =DispatcherMiddleware(app.wsgi_app, {'/metrics': metrics_wsgi_app()})
+# Request count, latency and in-progress metrics for every route, labelled by route template
+request_metrics = RequestMetrics(app)
+
+# Website check metrics, labelled by the checked url and its env from the config file
+CHECK_STATUSES = ('SUCCESS', 'CONTENT MISMATCH', 'CONNECTION ERROR')
+WEBSITE_RESPONSE_TIME = Histogram('website_response_time_seconds', 'Response time of website checks',
+                                  labelnames=['url', 'env'],
+                                  buckets=[0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0])
+WEBSITE_CHECKS = Counter('website_checks_total', 'Website checks by result status',
+                         labelnames=['url', 'env', 'status'])
+# With several workers only the one running the checker sets these, the latest value wins
+WEBSITE_LAST_SUCCESS = Gauge('website_last_success_timestamp_seconds',
+                             'Unix time of the last successful check', labelnames=['url', 'env'],
+                             multiprocess_mode='livemax')
+WEBSITE_UP = Gauge('website_up', '1 if the last check of the website succeeded, else 0',
+                   labelnames=['url', 'env'], multiprocess_mode='livemostrecent')
+
+LOG_RECORDS_DROPPED = Counter('log_records_dropped_total',
+                              'Log records dropped because the queue to the log writer thread was full')
+
+def init_website_metrics(url, env):
+    """Create the status series of a site at zero so rate() and absent() work before the first failure."""
+    for status in CHECK_STATUSES:
+        WEBSITE_CHECKS.labels(url, env, status)
+    WEBSITE_UP.labels(url, env)
+
+def remove_website_metrics(url, env):
+    """Drop the series of a site that is no longer monitored so it doesn't report a stale state."""
+    if MULTIPROCESS:
+        # Series can't be removed from the shared metric files, blank the state instead
+        WEBSITE_UP.labels(url, env).set(float('nan'))
+        return
+    for status in CHECK_STATUSES:
+        try:
+            WEBSITE_CHECKS.remove(url, env, status)
+        except KeyError:
+            pass
+    for metric in (WEBSITE_RESPONSE_TIME, WEBSITE_LAST_SUCCESS, WEBSITE_UP):
+        try:
+            metric.remove(url, env)
+        except KeyError:
+            pass
+
+def record_check(url, env, status, response_time=None, slo=None):
+    """Update the website metrics, and the site's SLO windows if given, with the outcome of one check."""
+    if slo is not None:
+        slo.record(status == 'SUCCESS', response_time)
+    WEBSITE_CHECKS.labels(url, env, status).inc()
+    if response_time is not None:
+        WEBSITE_RESPONSE_TIME.labels(url, env).observe(response_time)
+    if status == 'SUCCESS':
+        WEBSITE_UP.labels(url, env).set(1)
+        WEBSITE_LAST_SUCCESS.labels(url, env).set_to_current_time()
+    else:
+        WEBSITE_UP.labels(url, env).set(0)
+
+# Rolling SLO windows per site: name -> (length in seconds, bucket width in seconds)
+SLO_WINDOWS = {'5m': (300, 10), '1h': (3600, 60), '24h': (86400, 900)}
+SLO_TARGET = float(os.getenv('SLO_TARGET', '0.999'))  # default availability objective, per site 'slo_target'
+SLO_PERCENTILES = (0.5, 0.9, 0.99)
+# Latency sketch: log-spaced bins from LATENCY_MIN to LATENCY_MAX seconds, each value within
+# LATENCY_ACCURACY (relative) of the true one
+LATENCY_MIN = 0.001
+LATENCY_MAX = 60.0
+LATENCY_ACCURACY = 0.02
+LATENCY_GAMMA = (1 + LATENCY_ACCURACY) / (1 - LATENCY_ACCURACY)
+LATENCY_BINS = math.ceil(math.log(LATENCY_MAX / LATENCY_MIN, LATENCY_GAMMA)) + 1
+
+def latency_bin(seconds):
+    if seconds <= LATENCY_MIN:
+        return 0
+    return min(math.ceil(math.log(seconds / LATENCY_MIN, LATENCY_GAMMA)), LATENCY_BINS - 1)
+
+def latency_bin_value(index):
+    """Representative latency of a bin, within LATENCY_ACCURACY of every value in it."""
+    return LATENCY_MIN * LATENCY_GAMMA ** index * 2 / (LATENCY_GAMMA + 1) if index else LATENCY_MIN
+
+class RollingWindow:
+    """Check counts and a latency sketch over the last `length` seconds.
+
+    The window is a ring of fixed-width buckets. Running totals for the whole
+    window are kept next to the ring: a check adds to its bucket and the totals,
+    and a bucket that falls out of the window is subtracted before it is reused.
+    Reading the window never walks the ring, so it costs the same whatever the
+    number of checks.
+    """
+
+    def __init__(self, length, width):
+        self.width = width
+        self.size = length // width
+        self.checks = array('L', [0]) * self.size
+        self.good = array('L', [0]) * self.size
+        self.latencies = [None] * self.size  # per bucket {bin: count}, only for buckets that saw a check
+        self.total_checks = 0
+        self.total_good = 0
+        self.total_latency = array('L', [0]) * LATENCY_BINS
+        self.latency_count = 0
+        self.current = None  # absolute index of the newest bucket
+
+    def advance(self, now):
+        """Expire the buckets that fell out of the window by time `now`."""
+        index = int(now // self.width)
+        if self.current is None:
+            self.current = index
+        if index <= self.current:
+            return
+        for expired in range(max(self.current + 1, index - self.size + 1), index + 1):
+            slot = expired % self.size
+            self.total_checks -= self.checks[slot]
+            self.total_good -= self.good[slot]
+            self.checks[slot] = self.good[slot] = 0
+            if self.latencies[slot]:
+                for bin_index, count in self.latencies[slot].items():
+                    self.total_latency[bin_index] -= count
+                    self.latency_count -= count
+                self.latencies[slot] = None
+        self.current = index
+
+    def record(self, now, good, bin_index=None):
+        self.advance(now)
+        slot = self.current % self.size
+        self.checks[slot] += 1
+        self.total_checks += 1
+        if good:
+            self.good[slot] += 1
+            self.total_good += 1
+        if bin_index is not None:
+            if self.latencies[slot] is None:
+                self.latencies[slot] = {}
+            self.latencies[slot][bin_index] = self.latencies[slot].get(bin_index, 0) + 1
+            self.total_latency[bin_index] += 1
+            self.latency_count += 1
 
-def before_request():
-    request.start_time = time.time()
+    def percentiles(self, quantiles):
+        """Latency at each quantile from the window's sketch, None when there are no timings."""
+        if not self.latency_count:
+            return [None] * len(quantiles)
+        ranks = [q * (self.latency_count - 1) for q in quantiles]
+        values, seen, position = [], 0, 0
+        for bin_index, count in enumerate(self.total_latency):
+            seen += count
+            while position < len(ranks) and seen > ranks[position]:
+                values.append(latency_bin_value(bin_index))
+                position += 1
+            if position == len(ranks):
+                break
+        return values
 
-def after_request(response):
-    request_latency = time.time() - request.start_time 
-    LATENCY.labels(request.method,request.path).observe(request_latency)
-    IN_PROGRESS.labels(request.method,request.path).dec()
-    return response
+class SiteSLO:
+    """Availability, error budget burn and latency percentiles of one site over SLO_WINDOWS."""
+
+    def __init__(self, target=SLO_TARGET):
+        self.lock = threading.Lock()
+        self.target = target
+        self.windows = {name: RollingWindow(length, width) for name, (length, width) in SLO_WINDOWS.items()}
+
+    def record(self, good, response_time=None):
+        bin_index = latency_bin(response_time) if response_time is not None else None
+        now = time.monotonic()
+        with self.lock:
+            for window in self.windows.values():
+                window.record(now, good, bin_index)
+
+    def report(self):
+        now = time.monotonic()
+        budget = 1 - self.target
+        report = {}
+        with self.lock:
+            for name, window in self.windows.items():
+                window.advance(now)
+                checks, good = window.total_checks, window.total_good
+                error_rate = (checks - good) / checks if checks else None
+                # burn rate 1 spends exactly the error budget over the window, above 1 spends it faster
+                burn_rate = round(error_rate / budget, 4) if error_rate is not None and budget > 0 else None
+                report[name] = {
+                    'checks': checks,
+                    'good': good,
+                    'availability': good / checks if checks else None,
+                    'error_budget_burn_rate': burn_rate,
+                    'error_budget_remaining': round(1 - burn_rate, 4) if burn_rate is not None else None,
+                    'latency_seconds': {
+                        f'p{int(q * 100)}': round(value, 4) if value is not None else None
+                        for q, value in zip(SLO_PERCENTILES, window.percentiles(SLO_PERCENTILES))
+                    }
+                }
+        return report
+
+# SLO state of the monitored sites by site name, kept after logging stops so it can still be read
+site_slos = {}
+site_slos_lock = threading.Lock()
+
+def sync_site_slos(sites):
+    """Create SLO state for new sites, update targets and drop sites that are no longer monitored."""
+    with site_slos_lock:
+        for name in list(site_slos):
+            if name not in sites:
+                del site_slos[name]
+        for name, entry in sites.items():
+            target = entry.site.get('slo_target', SLO_TARGET)
+            slo = site_slos.get(name)
+            if slo is None:
+                slo = site_slos[name] = SiteSLO(target)
+            slo.target = target
+            entry.slo = slo
+
+@app.route('/sites/<path:name>/slo', methods=['GET'])
+def get_site_slo(name):
+    """Rolling availability, error budget burn and latency percentiles of a monitored site."""
+    slo = site_slos.get(name)
+    if slo is None:
+        return jsonify({'error': f"Unknown site '{name}'"}), 404
+    return jsonify({'site': name, 'target': slo.target, 'windows': slo.report()}), 200
 
 # Define a Gauge metric for unique string count
-UNIQUE_STRING_COUNT = Gauge('unique_string_count', 'Number of unique strings in the provided list')
+UNIQUE_STRING_COUNT = Gauge('unique_string_count', 'Number of unique strings posted since the last reset',
+                            multiprocess_mode='livemostrecent')
+
+# Unique string counting: exact up to UNIQUE_EXACT_LIMIT strings, then a HyperLogLog sketch
+UNIQUE_EXACT_LIMIT = int(os.getenv('UNIQUE_EXACT_LIMIT', '10000'))
+HLL_PRECISION = int(os.getenv('HLL_PRECISION', '14'))  # 2**14 registers = 16 KB, ~0.8% standard error
+
+class HyperLogLog:
+    """HyperLogLog cardinality sketch with 2**precision one-byte registers.
+
+    Memory is fixed by the precision no matter how many strings are added, and
+    two sketches with the same precision merge by taking the register-wise max.
+    """
+
+    # 2**-rank for every possible register value, so count() is a table lookup per register
+    INVERSE_POWERS = [2.0 ** -rank for rank in range(65)]
+
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError('precision must be between 4 and 16')
+        self.precision = precision
+        self.size = 1 << precision
+        if registers is None:
+            registers = bytearray(self.size)
+        elif len(registers) != self.size:
+            raise ValueError(f'expected {self.size} registers for precision {precision}, got {len(registers)}')
+        elif max(registers) > 65 - precision:
+            # add() never stores a rank above this, and count() has no table entry for larger values
+            raise ValueError(f'register values must be at most {65 - precision} for precision {precision}')
+        self.registers = bytearray(registers)
+
+    def add(self, value):
+        hashed = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+        index = hashed >> (64 - self.precision)
+        remaining = (hashed << self.precision) & 0xFFFFFFFFFFFFFFFF
+        # Position of the first 1-bit in the bits not used for the index
+        rank = min(64 - remaining.bit_length(), 64 - self.precision) + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        size = self.size
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(map(self.INVERSE_POWERS.__getitem__, self.registers))
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # Linear counting is more accurate while many registers are still empty
+            estimate = size * math.log(size / zeros)
+        return int(round(estimate))
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError(f'cannot merge precision {other.precision} into {self.precision}')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+class UniqueStringCounter:
+    """Counts distinct strings across requests until reset.
+
+    Keeps an exact set while it holds at most exact_limit strings and switches
+    to a HyperLogLog sketch after that, so memory stays bounded for large inputs.
+    """
+
+    def __init__(self, precision=HLL_PRECISION, exact_limit=UNIQUE_EXACT_LIMIT):
+        self.lock = threading.Lock()
+        self.reset(precision, exact_limit)
 
-# Global variable to store the current list of strings
-current_strings = []
+    def reset(self, precision=None, exact_limit=None):
+        # Validate both before changing anything; a string stored here would break every later add
+        if precision is not None and (not is_int(precision) or not 4 <= precision <= 16):
+            raise ValueError('precision must be an integer between 4 and 16')
+        if exact_limit is not None and (not is_int(exact_limit) or exact_limit < 0):
+            raise ValueError('exact_limit must be an integer of at least 0')
+        with self.lock:
+            if precision is not None:
+                self.precision = precision
+            if exact_limit is not None:
+                self.exact_limit = exact_limit
+            self.exact = set()
+            self.sketch = None
 
-def update_unique_string_count(strings):
-    """Update the unique string count metric based on the provided list."""
-    unique_strings = set(strings)  # Use a set to find unique strings
-    UNIQUE_STRING_COUNT.set(len(unique_strings))  # Set the metric value
+    def add_many(self, strings):
+        with self.lock:
+            if self.sketch is None:
+                self.exact.update(strings)
+                if len(self.exact) <= self.exact_limit:
+                    return
+                self.sketch = HyperLogLog(self.precision)
+                strings, self.exact = self.exact, set()
+            for value in strings:
+                self.sketch.add(value)
+
+    def merge(self, sketch):
+        with self.lock:
+            if self.sketch is None:
+                self.sketch = HyperLogLog(self.precision)
+                for value in self.exact:
+                    self.sketch.add(value)
+                self.exact = set()
+            self.sketch.merge(sketch)
+
+    def export(self):
+        """Return the state as a sketch (built from the exact set if needed) for merging elsewhere."""
+        with self.lock:
+            if self.sketch is not None:
+                return HyperLogLog(self.precision, self.sketch.registers)
+            sketch = HyperLogLog(self.precision)
+            for value in self.exact:
+                sketch.add(value)
+            return sketch
+
+    def count(self):
+        with self.lock:
+            return len(self.exact) if self.sketch is None else self.sketch.count()
+
+    def mode(self):
+        with self.lock:
+            return 'exact' if self.sketch is None else 'hyperloglog'
+
+unique_strings = UniqueStringCounter()
+
+def update_unique_string_count():
+    """Set the metric from the unique string counter and return the count.
+
+    count() sums every register in HyperLogLog mode, so this runs once per
+    request, not once per posted batch.
+    """
+    unique_count = unique_strings.count()
+    UNIQUE_STRING_COUNT.set(unique_count)
+    return unique_count
+
+def read_ndjson_strings(stream):
+    """Yield batches of strings from NDJSON lines without reading the whole body into memory.
+
+    Each line may be a string, a list of strings or an object with a 'strings' list.
+    """
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        item = json.loads(line)
+        if isinstance(item, dict):
+            item = item.get('strings')
+        if isinstance(item, str):
+            yield [item]
+        elif isinstance(item, list):
+            yield item
+        else:
+            raise ValueError(f'line {line_number}: expected a string, a list or an object with "strings"')
 
 @app.route('/count_unique_strings', methods=['POST'])
 def count_unique_strings():
-    global current_strings
-    data = request.json
-    if 'strings' not in data:
-        return jsonify({'error': 'Strings list is required'}), 400
+    """Add posted strings to the running unique count.
+
+    Accepts {"strings": [...]} (add "reset": true to start from zero) or a
+    streamed application/x-ndjson body of batches.
+    """
+    if request.mimetype == 'application/x-ndjson':
+        try:
+            for batch in read_ndjson_strings(request.stream):
+                unique_strings.add_many(str(value) for value in batch)
+        except ValueError as e:
+            # The lines before the bad one were added
+            update_unique_string_count()
+            return jsonify({'error': f'Invalid NDJSON: {e}'}), 400
+    else:
+        data = request.json
+        if 'strings' not in data:
+            return jsonify({'error': 'Strings list is required'}), 400
 
-    if not isinstance(data['strings'], list):
-        return jsonify({'error': 'Strings must be provided as a list'}), 400
+        if not isinstance(data['strings'], list):
+            return jsonify({'error': 'Strings must be provided as a list'}), 400
 
-    current_strings = data['strings']
-    update_unique_string_count(current_strings)
-    return jsonify({'message': f'Unique string count updated based on the provided list'}), 200
+        if data.get('reset'):
+            unique_strings.reset()
+        unique_strings.add_many(str(value) for value in data['strings'])
+    unique_count = update_unique_string_count()
+    return jsonify({
+        'message': 'Unique string count updated',
+        'unique_count': unique_count,
+        'mode': unique_strings.mode()
+    }), 200
+
+@app.route('/count_unique_strings/reset', methods=['POST'])
+def reset_unique_strings():
+    """Start counting from zero, optionally with a new 'precision' or 'exact_limit'."""
+    data = request.get_json(silent=True) or {}
+    try:
+        unique_strings.reset(data.get('precision'), data.get('exact_limit'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    UNIQUE_STRING_COUNT.set(0)
+    return jsonify({'message': 'Unique string count reset'}), 200
+
+@app.route('/count_unique_strings/sketch', methods=['GET'])
+def get_unique_strings_sketch():
+    """Export the current state as a HyperLogLog sketch that another instance can merge."""
+    sketch = unique_strings.export()
+    return jsonify({
+        'precision': sketch.precision,
+        'registers': base64.b64encode(sketch.registers).decode()
+    }), 200
+
+@app.route('/count_unique_strings/merge', methods=['POST'])
+def merge_unique_strings_sketch():
+    """Merge a sketch exported by /count_unique_strings/sketch into the running count."""
+    data = request.json
+    try:
+        sketch = HyperLogLog(data['precision'], base64.b64decode(data['registers']))
+        unique_strings.merge(sketch)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid sketch: {e}'}), 400
+    return jsonify({'unique_count': update_unique_string_count(), 'mode': unique_strings.mode()}), 200
 
 @app.get("/cars")
 def get_cards():
-    REQUESTS.labels('/cars','get').inc()
     #time.sleep(33)
     return ["toyota", "honda", "mazda" ,"lexus"]
 
 @app.post("/cars")
 def create_cars():
-    REQUESTS.labels('/cars','post').inc()
     #time.sleep(23)
     return "Create Car"
 
 @app.get("/boats")
 def get_boats():
-    REQUESTS.labels('/boats','get').inc()
     #time.sleep(65)
     return ["boat1","boat2","boat3"]
 
 @app.post("/boats")
 def create_boat():
-    REQUESTS.labels('/boats','post').inc()
     return "Create Boat"
 
 class JSONFormatter(logging.Formatter):
-    """Custom JSON formatter for logging."""
+    """Custom JSON formatter for logging.
+
+    A record whose message is a dict (like the website check results) has its
+    fields merged into the JSON line instead of being nested as a string.
+    """
     def format(self, record):
         log_record = {
             'timestamp': self.formatTime(record, self.datefmt),
             'level': record.levelname,
-            'message': record.getMessage(),
             'name': record.name,
             'filename': record.filename,
             'lineno': record.lineno
         }
-        return json.dumps(log_record)
+        if isinstance(record.msg, dict):
+            log_record.update(record.msg)
+        else:
+            log_record['message'] = record.getMessage()
+        if record.exc_info:
+            log_record['exception'] = self.formatException(record.exc_info)
+        return dumps(log_record)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks the caller.
+
+    Formatting is left to the writer thread, and records are dropped (and
+    counted in log_records_dropped_total) when the queue is full, so a slow
+    disk can't stall the checks.
+    """
+
+    def prepare(self, record):
+        # Resolve %-style args now so later changes to them can't alter the line
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
 
 def load_config(config_file):
     """Load configuration from a JSON file."""
     with open(config_file, 'r') as f:
         return json.load(f)
 
-def check_website(url, content, env):
-    """Check the website and log the result with environment information."""
+# DNS, connect and TLS time of the connection used by the current check (per worker thread)
+check_timings = threading.local()
+
+# Every socket opened for a check, so in-flight checks can be aborted on shutdown
+open_sockets = weakref.WeakSet()
+
+def abort_open_connections():
+    """Shut down all check sockets; blocked reads return at once and the check fails fast."""
+    for sock in list(open_sockets):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+# getaddrinfo() has no timeout of its own, so lookups run here and are waited for up to the connect timeout
+dns_executor = ThreadPoolExecutor(max_workers=DNS_LOOKUP_THREADS, thread_name_prefix='dns-lookup')
+
+class TimedConnectionMixin:
+    """Records DNS lookup, TCP connect and TLS handshake time of new connections in check_timings.
+
+    The name is resolved once, then every address is tried in order like urllib3
+    does itself, so a host with several A/AAAA records still falls back to the next.
+    """
+
+    def _new_conn(self):
+        host = self._dns_host
+        timeout = self.timeout if isinstance(self.timeout, (int, float)) else None
+        start = time.perf_counter()
+        lookup = dns_executor.submit(socket.getaddrinfo, host.strip('[]'), self.port, allowed_gai_family(),
+                                     socket.SOCK_STREAM)
+        try:
+            addresses = list(dict.fromkeys(info[4][0] for info in lookup.result(timeout)))
+        except FutureTimeoutError:
+            raise ConnectTimeoutError(self, f'DNS lookup of {self.host} timed out. (connect timeout={timeout})')
+        except (OSError, UnicodeError):
+            addresses = []
+        if not addresses:
+            # Let urllib3 resolve the name itself so it raises its usual error
+            sock = super()._new_conn()
+            open_sockets.add(sock)
+            return sock
+        resolved = time.perf_counter()
+        error = None
+        try:
+            for address in addresses:
+                # Connect to the addresses we just resolved instead of resolving the name again
+                self._dns_host = address
+                try:
+                    sock = super()._new_conn()
+                    break
+                except (ConnectTimeoutError, NewConnectionError) as e:
+                    error = e
+            else:
+                raise error
+        finally:
+            self._dns_host = host
+        open_sockets.add(sock)
+        check_timings.dns = resolved - start
+        check_timings.connect = time.perf_counter() - resolved
+        return sock
+
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        if isinstance(self, HTTPSConnection):
+            check_timings.tls = time.perf_counter() - start - check_timings.dns - check_timings.connect
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    pass
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools use the timed connection classes."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool
+        }
+
+# One keep-alive session per host, so steady-state checks reuse an open connection
+sessions = {}
+sessions_lock = threading.Lock()
+session_pool_size = DEFAULT_MAX_CONCURRENCY
+
+def get_session(url):
+    """Return the pooled session for the url's host, creating it on first use."""
+    host = urlsplit(url).netloc
+    with sessions_lock:
+        session = sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = TimedHTTPAdapter(pool_connections=1, pool_maxsize=session_pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            sessions[host] = session
+        return session
+
+def close_unused_sessions(hosts):
+    """Close the sessions of hosts that are no longer checked."""
+    with sessions_lock:
+        for host in [host for host in sessions if host not in hosts]:
+            sessions.pop(host).close()
+
+def reset_sessions(pool_size):
+    """Close all pooled sessions and size new pools for the given check concurrency."""
+    global session_pool_size
+    with sessions_lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
+        session_pool_size = pool_size
+
+class ContentMatcher:
+    """Looks for a site's markers in a response body streamed as raw byte chunks.
+
+    A site can use 'content' (one string), 'contents' (a list) with 'match' set
+    to 'all' (default) or 'any', and/or a 'regex'. The end of each chunk is
+    carried over to the next one so markers split across chunks are still found.
+    """
+
+    def __init__(self, markers, regex=None, mode='all', max_bytes=DEFAULT_MAX_BYTES):
+        if mode not in ('all', 'any'):
+            raise ValueError(f"match must be 'all' or 'any', not {mode!r}")
+        if not all(isinstance(marker, str) for marker in markers):
+            raise ValueError("'content' and 'contents' must be strings")
+        if regex is not None and not isinstance(regex, str):
+            raise ValueError("'regex' must be a string")
+        self.markers = tuple(marker.encode() for marker in markers)
+        self.regex = re.compile(regex.encode()) if regex else None
+        self.mode = mode
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def from_site(cls, site):
+        contents = site.get('contents', [])
+        if not isinstance(contents, list):
+            raise ValueError("'contents' must be a list of strings")
+        markers = list(contents)
+        if 'content' in site:
+            markers.append(site['content'])
+        if not markers and not site.get('regex'):
+            raise ValueError(f"site {site.get('url')} needs 'content', 'contents' or 'regex'")
+        return cls(markers, site.get('regex'), site.get('match', 'all'), site.get('max_bytes', DEFAULT_MAX_BYTES))
+
+    def search(self, chunks, stop_event=None):
+        """Consume chunks until the markers match, max_bytes is read or stop_event is set.
+
+        Returns (matched, bytes_read).
+        """
+        pending = [marker for marker in self.markers if marker]
+        regex_pending = self.regex is not None
+        if (not pending and not regex_pending) or (self.mode == 'any' and len(pending) < len(self.markers)):
+            return True, 0
+
+        tail = b''
+        bytes_read = 0
+        for chunk in chunks:
+            if stop_event is not None and stop_event.is_set():
+                break
+            chunk = chunk[:self.max_bytes - bytes_read]
+            bytes_read += len(chunk)
+            window = tail + chunk
+            found = [marker for marker in pending if marker in window]
+            if regex_pending and self.regex.search(window):
+                regex_pending = False
+                found.append(None)
+            if found:
+                if self.mode == 'any':
+                    return True, bytes_read
+                pending = [marker for marker in pending if marker not in found]
+                if not pending and not regex_pending:
+                    return True, bytes_read
+            if bytes_read >= self.max_bytes:
+                break
+            overlap = max((len(marker) - 1 for marker in pending), default=0)
+            if regex_pending:
+                overlap = max(overlap, REGEX_WINDOW)
+            tail = window[-overlap:] if overlap else b''
+        return False, bytes_read
+
+def release_response(response, chunks):
+    """Return the connection to the pool if little is left unread, otherwise close it.
+
+    chunks is the iter_content() iterator the body was read with. With a
+    Content-Length the rest is drained only if it is at most DRAIN_LIMIT.
+    Without one (chunked responses) chunks is read on for up to DRAIN_LIMIT
+    more bytes and the connection is kept if the body ended within it. urllib3
+    closes the connection when that iterator is dropped in the middle of a
+    chunked body, so it has to be kept until now.
+    """
+    length = response.headers.get('Content-Length')
+    try:
+        if length is not None and length.isdigit():
+            if int(length) - response.raw.tell() <= DRAIN_LIMIT:
+                response.raw.drain_conn()
+        else:
+            drained = 0
+            for chunk in chunks:
+                drained += len(chunk)
+                if drained > DRAIN_LIMIT:
+                    break
+    except Exception:
+        pass
+    response.close()
+
+def check_website(url, content, env, timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_CHECK_TIMEOUT), stop_event=None,
+                  slo=None):
+    """Check the website and log the result with environment information.
+
+    content is a marker string or a ContentMatcher. The body is streamed and
+    reading stops as soon as the markers are found or max_bytes is reached.
+    A check cut short because stop_event was set is not logged or counted.
+    The result is also added to the SiteSLO given as slo.
+    """
+    if not isinstance(content, ContentMatcher):
+        content = ContentMatcher([content])
+    check_timings.dns = check_timings.connect = check_timings.tls = 0.0
     try:
         start_time = time.time()
-        response = requests.get(url)
+        response = get_session(url).get(url, timeout=timeout, stream=True)
+        chunks = response.iter_content(CHECK_CHUNK_SIZE)
+        try:
+            matched, bytes_read = content.search(chunks, stop_event)
+        finally:
+            release_response(response, chunks)
         end_time = time.time()
+        if stop_event is not None and stop_event.is_set():
+            return
 
-        if content in response.text:
-            logging.info(json.dumps({
+        # requests' elapsed runs until the response headers arrive, including connection setup
+        setup = check_timings.dns + check_timings.connect + check_timings.tls
+        timings = {
+            'dns': round(check_timings.dns, 4),
+            'connect': round(check_timings.connect, 4),
+            'tls': round(check_timings.tls, 4),
+            'ttfb': round(response.elapsed.total_seconds() - setup, 4)
+        }
+        if matched:
+            record_check(url, env, 'SUCCESS', end_time - start_time, slo)
+            logging.info({
                 'url': url,
                 'status': 'SUCCESS',
                 'response_time': f'{end_time - start_time:.2f}s',
+                'timings': timings,
+                'bytes_read': bytes_read,
                 'env': env
-            }))
+            })
         else:
-            logging.warning(json.dumps({
+            record_check(url, env, 'CONTENT MISMATCH', end_time - start_time, slo)
+            logging.warning({
                 'url': url,
                 'status': 'CONTENT MISMATCH',
+                'timings': timings,
+                'bytes_read': bytes_read,
                 'env': env
-            }))
+            })
     except requests.exceptions.RequestException as e:
-        logging.error(json.dumps({
+        if stop_event is not None and stop_event.is_set():
+            return
+        record_check(url, env, 'CONNECTION ERROR', slo=slo)
+        logging.error({
             'url': url,
             'status': 'CONNECTION ERROR',
             'error': str(e),
             'env': env
-        }))
+        })
 
 def setup_logging():
-    """Set up logging configuration for both console and file."""
-    # Create a logger
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
-
-    # File handler for writing logs to a file
-    file_handler = logging.FileHandler('monitor.log')
-    file_handler.setLevel(logging.INFO)
-    file_formatter = logging.Formatter('%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-    file_handler.setFormatter(file_formatter)
-    
-    # Console handler for printing logs to the console
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
-    console_formatter = logging.Formatter('%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-    console_handler.setFormatter(console_formatter)
-
-    # Add handlers to the logger
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
-
-
-def enable_website_logs(config, interval):
-    """Logging function to check websites periodically."""
-    global stop_logging
-    while not stop_logging:
-        for site in config['sites']:
-            check_website(site['url'], site['content'], site['env'])
-        time.sleep(interval)
+    """Set up logging configuration for both console and file.
+
+    The root logger only gets a queue handler; a QueueListener thread owns the
+    rotating file handler and the console handler and does all formatting and
+    I/O. Safe to call more than once, the handlers are only created the first time.
+    """
+    global log_listener
+    with log_setup_lock:
+        if log_listener is not None:
+            return
+
+        # Create a logger
+        logger = logging.getLogger()
+        logger.setLevel(logging.INFO)
+        formatter = JSONFormatter(datefmt='%Y-%m-%d %H:%M:%S')
+
+        # File handler for writing logs to a file, rotated by time if LOG_ROTATE_WHEN is set, else by size
+        if LOG_ROTATE_WHEN:
+            file_handler = logging.handlers.TimedRotatingFileHandler(
+                LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT)
+        else:
+            file_handler = logging.handlers.RotatingFileHandler(
+                LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+        file_handler.setLevel(logging.INFO)
+        file_handler.setFormatter(formatter)
+
+        # Console handler for printing logs to the console
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(logging.INFO)
+        console_handler.setFormatter(formatter)
+
+        # Only the queue handler runs on the calling thread
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        logger.addHandler(DroppingQueueHandler(log_queue))
+        log_listener = logging.handlers.QueueListener(
+            log_queue, file_handler, console_handler, respect_handler_level=True)
+        log_listener.start()
+        # Flush whatever is still queued when the process exits
+        atexit.register(log_listener.stop)
+
+
+def site_name(site):
+    """A site is identified by its 'name', or by its url when it has none."""
+    return site.get('name', site['url'])
+
+def next_deadline(deadline, site_interval, now):
+    """Advance a site's deadline by whole intervals, skipping slots that were missed."""
+    deadline += site_interval
+    if deadline < now:
+        deadline += (int((now - deadline) / site_interval) + 1) * site_interval
+    return deadline
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def is_positive(value, integer=False):
+    """True for a finite number above 0 (an int when integer is set), bools excluded."""
+    return (is_int(value) if integer else is_number(value)) and 0 < value < math.inf
+
+class ScheduledSite:
+    """A site in the running schedule, with its matcher, deadline and last check."""
+
+    def __init__(self, site, interval):
+        self.site = site
+        self.name = site_name(site)
+        if 'env' not in site:
+            # apply_site_changes() needs it after the schedule was changed, so check it up front
+            raise KeyError(f"site '{self.name}' needs 'env'")
+        self.matcher = ContentMatcher.from_site(site)
+        self.interval = site.get('interval', interval)
+        self.jitter = site.get('jitter', 0)
+        # A zero or non-numeric interval would crash the checker thread in next_deadline()
+        if not is_number(self.interval) or not 0 < self.interval < math.inf:
+            raise ValueError(f"site '{self.name}': interval must be a number greater than 0")
+        if not is_number(self.jitter) or not 0 <= self.jitter < math.inf:
+            raise ValueError(f"site '{self.name}': jitter must be a number of at least 0")
+        # These are only used inside a check, where a bad value used to fail without any log line
+        for key in ('timeout', 'connect_timeout'):
+            if key in site and not is_positive(site[key]):
+                raise ValueError(f"site '{self.name}': {key} must be a number of seconds greater than 0")
+        if 'max_bytes' in site and not is_positive(site['max_bytes'], integer=True):
+            raise ValueError(f"site '{self.name}': max_bytes must be an integer greater than 0")
+        if 'slo_target' in site and not (is_number(site['slo_target']) and 0 < site['slo_target'] < 1):
+            raise ValueError(f"site '{self.name}': slo_target must be a number between 0 and 1")
+        self.deadline = None
+        self.future = None
+        self.slo = None
+
+class SiteSchedule:
+    """Min-heap of next-due checks for the monitored sites.
+
+    Heap entries are (due, seq, ScheduledSite). Replacing or removing a site
+    only updates self.sites; its old heap entry is skipped when it reaches the
+    top, so a config change never has to search or rebuild the heap.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.heap = []
+        self.sites = {}
+        self.counter = itertools.count()
+
+    def schedule(self, entry, deadline):
+        entry.deadline = deadline
+        due = deadline + random.uniform(-entry.jitter, entry.jitter) if entry.jitter else deadline
+        heapq.heappush(self.heap, (due, next(self.counter), entry))
+
+    def load(self, sites):
+        """Make the schedule match the given site list.
+
+        Unchanged sites keep their entry and slot, changed sites keep their slot
+        unless their interval changed, new ones are staggered across their
+        interval. Returns (added, removed, changed) where changed holds
+        (old, new) pairs. Raises ValueError, TypeError or KeyError for an
+        invalid list without touching the running schedule.
+        """
+        if not isinstance(sites, list):
+            raise ValueError("'sites' must be a list")
+        wanted = {}
+        for site in sites:
+            if not isinstance(site, dict):
+                raise ValueError(f'site must be an object, got {site!r}')
+            name = site_name(site)
+            if name in wanted:
+                raise ValueError(f"duplicate site name '{name}', give one of them a 'name'")
+            wanted[name] = site
+        # Build (and so validate) every new or changed entry before self.sites or the heap
+        # change, so a bad site leaves the whole schedule as it was
+        updates = {name: ScheduledSite(site, self.interval) for name, site in wanted.items()
+                   if name not in self.sites or self.sites[name].site != site}
+
+        removed = [self.sites.pop(name) for name in list(self.sites) if name not in wanted]
+        added, changed, unscheduled = [], [], []
+        for name, entry in updates.items():
+            old = self.sites.get(name)
+            self.sites[name] = entry
+            if old is None:
+                added.append(entry)
+                unscheduled.append(entry)
+                continue
+            changed.append((old, entry))
+            entry.future = old.future
+            if entry.interval == old.interval and old.deadline is not None:
+                self.schedule(entry, old.deadline)
+            else:
+                unscheduled.append(entry)
+
+        # Stagger start times so new sites don't all fire in one burst
+        now = time.monotonic()
+        for position, entry in enumerate(unscheduled):
+            self.schedule(entry, now + entry.interval * position / len(unscheduled))
+        return added, removed, changed
+
+    def next_due(self):
+        """Return the due time of the next live entry, or None if nothing is scheduled."""
+        while self.heap and self.sites.get(self.heap[0][2].name) is not self.heap[0][2]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop(self):
+        return heapq.heappop(self.heap)[2]
+
+    def reschedule(self, entry, now):
+        self.schedule(entry, next_deadline(entry.deadline, entry.interval, now))
+
+def log_failed_check(url, future):
+    """Log a check that raised instead of logging its result, so it can't fail silently."""
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        logging.error({'url': url, 'status': 'CHECK FAILED', 'error': repr(error)}, exc_info=error)
+
+def apply_site_changes(schedule, sites):
+    """Load a new site list into the schedule and update metrics and sessions for what changed."""
+    added, removed, changed = schedule.load(sites)
+    for entry in removed:
+        remove_website_metrics(entry.site['url'], entry.site['env'])
+    for old, new in changed:
+        if (old.site['url'], old.site['env']) != (new.site['url'], new.site['env']):
+            remove_website_metrics(old.site['url'], old.site['env'])
+    for entry in added + [new for _, new in changed]:
+        init_website_metrics(entry.site['url'], entry.site['env'])
+    sync_site_slos(schedule.sites)
+    # Sessions of hosts that are still checked stay open with their pooled connections
+    close_unused_sessions({urlsplit(entry.site['url']).netloc for entry in schedule.sites.values()})
+    return added, removed, changed
+
+def config_mtime(config_file):
+    try:
+        return os.stat(config_file).st_mtime_ns
+    except OSError:
+        return None
+
+class WebsiteMonitor:
+    """Owns the checker thread and its lifecycle.
+
+    The checker waits on an Event instead of sleeping, so stop() wakes it at
+    once. stop() also cancels queued checks and aborts in-flight ones by
+    shutting down their sockets, and returns within the given deadline.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.executor = None
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, config, interval, max_concurrency=DEFAULT_MAX_CONCURRENCY, timeout=DEFAULT_CHECK_TIMEOUT,
+              connect_timeout=DEFAULT_CONNECT_TIMEOUT, config_file=None):
+        """Start checking the config's sites; returns False if the monitor is already running."""
+        with self.lock:
+            if self.is_running():
+                return False
+            self.stop_event = threading.Event()
+            self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='website-check')
+            self.thread = threading.Thread(
+                target=self.run, name='website-monitor', daemon=True,
+                args=(self.stop_event, self.executor, config, interval, max_concurrency, timeout,
+                      connect_timeout, config_file))
+            self.thread.start()
+            return True
+
+    def stop(self, deadline=SHUTDOWN_TIMEOUT):
+        """Stop the checker and cancel in-flight checks; returns True if it stopped within deadline seconds."""
+        with self.lock:
+            if self.thread is None:
+                return True
+            self.stop_event.set()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            abort_open_connections()
+            self.thread.join(deadline)
+            stopped = not self.thread.is_alive()
+            self.thread = None
+            self.executor = None
+            return stopped
+
+    def run(self, stop_event, executor, config, interval, max_concurrency, timeout, connect_timeout, config_file):
+        """Check websites periodically until stop_event is set.
+
+        Each site runs on its own 'interval' (default: the global interval) with an
+        optional +/- 'jitter' in seconds. Next-due times live in a min-heap. Deadlines
+        advance from the previous deadline, not from when the check finished, so the
+        period does not drift. Checks run on a bounded pool and a site is skipped
+        for a slot if its previous check is still running. Sites may also override
+        'timeout' (read) and 'connect_timeout'.
+
+        When config_file is given its mtime is polled every CONFIG_POLL_INTERVAL
+        seconds and a changed file is applied to the running schedule.
+        """
+        try:
+            schedule = SiteSchedule(interval)
+            reset_sessions(max_concurrency)
+            apply_site_changes(schedule, config['sites'])
+            last_mtime = config_mtime(config_file) if config_file else None
+            next_config_check = time.monotonic() + CONFIG_POLL_INTERVAL
+
+            while not stop_event.is_set():
+                now = time.monotonic()
+                if config_file and now >= next_config_check:
+                    next_config_check = now + CONFIG_POLL_INTERVAL
+                    mtime = config_mtime(config_file)
+                    if mtime is not None and mtime != last_mtime:
+                        last_mtime = mtime
+                        try:
+                            reload_config(schedule, config_file)
+                        except Exception:
+                            # A failed reload must never stop the checks that are already running
+                            logging.exception({'status': 'CONFIG RELOAD FAILED', 'config_file': config_file})
+
+                due = schedule.next_due()
+                if due is None or due > now:
+                    wait_until = next_config_check if config_file else now + CONFIG_POLL_INTERVAL
+                    if due is not None:
+                        wait_until = min(wait_until, due)
+                    stop_event.wait(max(0.0, wait_until - now))
+                    continue
+
+                entry = schedule.pop()
+                if entry.future is None or entry.future.done():
+                    site = entry.site
+                    site_timeout = (site.get('connect_timeout', connect_timeout), site.get('timeout', timeout))
+                    try:
+                        entry.future = executor.submit(check_website, site['url'], entry.matcher, site['env'],
+                                                       site_timeout, stop_event, entry.slo)
+                        entry.future.add_done_callback(lambda future, url=site['url']: log_failed_check(url, future))
+                    except RuntimeError:
+                        # The executor was shut down by stop()
+                        break
+                schedule.reschedule(entry, now)
+        finally:
+            # Also reached when run() fails, so the worker threads never outlive it
+            executor.shutdown(wait=False, cancel_futures=True)
+
+monitor = WebsiteMonitor()
+
+def reload_config(schedule, config_file):
+    """Apply a changed config file to the running schedule, keeping the old one if it is invalid."""
+    try:
+        config = load_config(config_file)
+        added, removed, changed = apply_site_changes(schedule, config['sites'])
+    except (OSError, ValueError, KeyError, TypeError, re.error) as e:
+        logging.error({'status': 'CONFIG RELOAD FAILED', 'config_file': config_file, 'error': str(e)})
+        return
+    if added or removed or changed:
+        logging.info({
+            'status': 'CONFIG RELOADED',
+            'config_file': config_file,
+            'added': [entry.name for entry in added],
+            'removed': [entry.name for entry in removed],
+            'changed': [new.name for _, new in changed]
+        })
 
 @app.route('/start_logging', methods=['POST'])
 def start_monitoring():
     """Start Logging websites."""
-    global monitoring_thread, stop_logging
-
-    if monitoring_thread is not None and monitoring_thread.is_alive():
+    if monitor.is_running():
         return jsonify({'status': 'Logging is already running'}), 400
 
     config_file = request.json.get('config_file', 'config.json')
     interval = request.json.get('interval', 60)
+    max_concurrency = request.json.get('max_concurrency', DEFAULT_MAX_CONCURRENCY)
+    timeout = request.json.get('timeout', DEFAULT_CHECK_TIMEOUT)
+    connect_timeout = request.json.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT)
+
+    if not is_positive(max_concurrency, integer=True):
+        return jsonify({'error': 'max_concurrency must be an integer greater than 0'}), 400
+    for name, value in (('interval', interval), ('timeout', timeout), ('connect_timeout', connect_timeout)):
+        if not is_positive(value):
+            return jsonify({'error': f'{name} must be a number of seconds greater than 0'}), 400
 
     config = load_config(config_file)
+    try:
+        SiteSchedule(interval).load(config['sites'])
+    except (ValueError, TypeError, KeyError, re.error) as e:
+        return jsonify({'error': f'Invalid site in {config_file}: {e}'}), 400
     setup_logging()
 
-    stop_logging = False
-    monitoring_thread = threading.Thread(target=enable_website_logs, args=(config, interval))
-    monitoring_thread.start()
+    if not monitor.start(config, interval, max_concurrency, timeout, connect_timeout, config_file):
+        return jsonify({'status': 'Logging is already running'}), 400
 
     return jsonify({'status': 'Application Logging is started!!!!!!!!'}), 200
 
 @app.route('/stop_logging', methods=['POST'])
 def stop_monitoring_endpoint():
     """Stop Logging websites."""
-    global stop_logging, monitoring_thread
-
-    if monitoring_thread is None or not monitoring_thread.is_alive():
+    if not monitor.is_running():
         return jsonify({'status': 'Application Logging is stopped....'}), 400
 
-    stop_logging = True
-    monitoring_thread.join()
-    monitoring_thread = None 
-
+    if not monitor.stop():
+        return jsonify({'status': 'Logging stopped, some checks were still finishing'}), 200
     return jsonify({'status': 'Logging stopped'}), 200
 
 @app.route('/logging_status', methods=['GET'])
 def status():
     """Check the status of the Application Logging."""
-    global monitoring_thread
-
-    if monitoring_thread is not None and monitoring_thread.is_alive():
+    if monitor.is_running():
         return jsonify({'status': 'Logging is enabled'}), 200
     else:
         return jsonify({'status': 'Logging is not Enabled'}), 200
 
+def handle_sigterm(signum, frame):
+    """Stop the checks within SHUTDOWN_TIMEOUT when the pod is terminated, then exit.
+
+    Under gunicorn the worker's own SIGTERM handler runs afterwards so the
+    worker still shuts down gracefully.
+    """
+    monitor.stop()
+    if callable(previous_sigterm_handler):
+        previous_sigterm_handler(signum, frame)
+    else:
+        raise SystemExit(0)
+
+# Signal handlers can only be installed from the main thread
+previous_sigterm_handler = None
+if threading.current_thread() is threading.main_thread():
+    previous_sigterm_handler = signal.signal(signal.SIGTERM, handle_sigterm)
+
 if __name__ == "__main__":
-    app.before_request(before_request)
-    app.after_request(after_request) 
     app.run(host='0.0.0.0', port=5000)
@@ -1,79 +1,763 @@
-from flask import Flask, render_template
+from flask import Flask, render_template, Response, request, jsonify
+from array import array
+from bisect import bisect_left
+import heapq
+import math
+import os
+import threading
+import time
 import psutil
 
 app = Flask(__name__)
 
+# How often the background sampler reads psutil (seconds)
+SAMPLE_INTERVAL = float(os.getenv('SAMPLE_INTERVAL', '5'))
+
+# Helper function to turn '10s', '5m', '1h', '1d' or a plain number of seconds into seconds
+def parse_duration(text):
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    text = str(text).strip().lower()
+    if text and text[-1] in units:
+        seconds = float(text[:-1]) * units[text[-1]]
+    else:
+        seconds = float(text)
+    if seconds <= 0 or math.isinf(seconds) or math.isnan(seconds):
+        raise ValueError(f'duration must be positive: {text!r}')
+    return seconds
+
+# Helper function to get how much a cumulative counter moved between two samples.
+# psutil already undoes 32-bit wraps while the process runs; a value that still
+# went backwards either wrapped at 2**32 before we saw it or the device was reset.
+def counter_delta(current, previous):
+    if current >= previous:
+        return current - previous
+    if previous < 2 ** 32:
+        return current + 2 ** 32 - previous
+    return current
+
+# How much history to keep in memory for /metrics/history
+HISTORY_RETENTION = parse_duration(os.getenv('HISTORY_RETENTION', '24h'))
+
+# Series recorded in the history buffers and the unit each one is stored in
+HISTORY_UNITS = {
+    'cpu': 'percent',
+    'memory': 'percent',
+    'disk': 'percent',
+    'network_sent': 'bytes_per_second',
+    'network_recv': 'bytes_per_second'
+}
+
+# Upper bound on the number of points a single history query may return
+HISTORY_MAX_POINTS = 10000
+
+# How often the process sampler walks the process table (seconds)
+PROCESS_SAMPLE_INTERVAL = float(os.getenv('PROCESS_SAMPLE_INTERVAL', '10'))
+
+# Fraction of one CPU the process sampler may spend; it samples less often to stay under this
+PROCESS_CPU_BUDGET = float(os.getenv('PROCESS_CPU_BUDGET', '0.02'))
+
+# Only these attributes are read per process; each extra one costs syscalls on every pass
+PROCESS_ATTRS = ['pid', 'name', 'create_time', 'cpu_times', 'memory_info', 'io_counters']
+
+# Columns of a process row and the ones /metrics/processes can sort by
+PROCESS_FIELDS = ('pid', 'name', 'cpu_percent', 'rss_bytes', 'io_bytes_per_sec')
+PROCESS_SORT_KEYS = {'cpu': 2, 'rss': 3, 'io': 4}
+
+# Container mode reads cgroup v2 files instead of host-wide psutil numbers for CPU and memory.
+# 'auto' turns it on when CGROUP_PATH has limit files, which is the case inside a pod
+# but not at the root cgroup of a VM.
+CONTAINER_MODE = os.getenv('CONTAINER_MODE', 'auto').lower()
+CGROUP_PATH = os.getenv('CGROUP_PATH', '/sys/fs/cgroup')
+CGROUP_FILES = ('memory.current', 'memory.max', 'memory.stat', 'cpu.max', 'cpu.stat',
+                'cpu.pressure', 'memory.pressure', 'io.pressure', 'io.stat')
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
 # Helper function to convert bytes to megabytes
 def bytes_to_mb(size_bytes):
     return round(size_bytes / (1024 * 1024), 2)
 
+# Helper function to escape a label value for the Prometheus text format
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Helper function to append one metric family (HELP, TYPE and samples) to the output lines
+def add_metric(lines, name, metric_type, help_text, samples):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} {metric_type}')
+    for labels, value in samples:
+        if labels:
+            label_str = ','.join(f'{key}="{escape_label(val)}"' for key, val in labels.items())
+            lines.append(f'{name}{{{label_str}}} {float(value)!r}')
+        else:
+            lines.append(f'{name} {float(value)!r}')
+
+# Helper functions to parse the cgroup v2 file formats
+def parse_cgroup_max(text):
+    # memory.max holds bytes or 'max' when there is no limit
+    text = text.strip()
+    return None if text == 'max' else int(text)
+
+def parse_cgroup_keyed(text):
+    # cpu.stat / memory.stat: one 'key value' pair per line
+    values = {}
+    for line in text.splitlines():
+        key, _, value = line.partition(' ')
+        if value:
+            values[key] = int(value)
+    return values
+
+def parse_cgroup_pressure(text):
+    # 'some avg10=0.00 avg60=0.00 avg300=0.00 total=0' and the same for 'full'
+    pressure = {}
+    for line in text.splitlines():
+        kind, *fields = line.split()
+        pressure[kind] = {}
+        for field in fields:
+            key, _, value = field.partition('=')
+            pressure[kind][key] = int(value) if key == 'total' else float(value)
+    return pressure
+
+def parse_cgroup_io_stat(text):
+    # '8:0 rbytes=1 wbytes=2 rios=3 wios=4 dbytes=0 dios=0', one line per device
+    devices = {}
+    for line in text.splitlines():
+        device, *fields = line.split()
+        devices[device] = {key: int(value) for key, _, value in (f.partition('=') for f in fields)}
+    return devices
+
+
+class CgroupReader:
+    """Reads the cgroup v2 interface files of the container this process runs in.
+
+    Every file is opened once; a sample re-reads each one with pread at offset 0,
+    which is a single syscall per file and never spawns a subprocess.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fds = {}
+        for name in CGROUP_FILES:
+            try:
+                self.fds[name] = os.open(os.path.join(path, name), os.O_RDONLY)
+            except OSError:
+                continue
+
+    @staticmethod
+    def enabled(mode, path):
+        if mode in ('on', 'true', '1'):
+            return True
+        if mode != 'auto':
+            return False
+        return any(os.path.exists(os.path.join(path, name)) for name in ('memory.max', 'cpu.max'))
+
+    def read(self, name):
+        fd = self.fds.get(name)
+        if fd is None:
+            return None
+        try:
+            return os.pread(fd, 65536, 0).decode()
+        except OSError:
+            return None
+
+    def sample(self):
+        data = {'memory_usage': None, 'memory_limit': None, 'memory_stat': {}, 'cpu_stat': {},
+                'cpu_limit_cores': None, 'pressure': {}, 'io': {}}
+        text = self.read('memory.current')
+        if text is not None:
+            data['memory_usage'] = int(text)
+        text = self.read('memory.max')
+        if text is not None:
+            data['memory_limit'] = parse_cgroup_max(text)
+        text = self.read('memory.stat')
+        if text is not None:
+            data['memory_stat'] = parse_cgroup_keyed(text)
+        text = self.read('cpu.stat')
+        if text is not None:
+            data['cpu_stat'] = parse_cgroup_keyed(text)
+        text = self.read('cpu.max')
+        if text is not None:
+            # '<quota> <period>' in microseconds, quota is 'max' when unlimited
+            quota, _, period = text.strip().partition(' ')
+            if quota != 'max':
+                data['cpu_limit_cores'] = int(quota) / int(period)
+        for resource in ('cpu', 'memory', 'io'):
+            text = self.read(f'{resource}.pressure')
+            if text is not None:
+                data['pressure'][resource] = parse_cgroup_pressure(text)
+        text = self.read('io.stat')
+        if text is not None:
+            data['io'] = parse_cgroup_io_stat(text)
+        return data
+
+
+class MetricHistory:
+    """Fixed-size ring buffers of recent samples, one array('d') per metric.
+
+    All metrics are sampled together, so they share one timestamp ring and one
+    write position. Memory is 8 bytes per metric per slot and never grows.
+    """
+
+    def __init__(self, capacity, metrics):
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.series = {name: array('d', bytes(8 * capacity)) for name in metrics}
+        self.position = 0
+        self.count = 0
+
+    def record(self, timestamp, values):
+        self.timestamps[self.position] = timestamp
+        for name, ring in self.series.items():
+            ring[self.position] = values[name]
+        self.position = (self.position + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def ordered(self, name):
+        # Returns copies of (timestamps, values) oldest first
+        ring = self.series[name]
+        if self.count < self.capacity:
+            return self.timestamps[:self.count], ring[:self.count]
+        pos = self.position
+        return self.timestamps[pos:] + self.timestamps[:pos], ring[pos:] + ring[:pos]
+
+    @staticmethod
+    def downsample(timestamps, values, start, end, step):
+        # Buckets are aligned to multiples of step so repeated queries line up.
+        # Each bucket is located with bisect and reduced with min/max/sum over
+        # an array slice, so the per-sample work happens in C.
+        bucket_start = math.floor(start / step) * step
+        lo = bisect_left(timestamps, start)
+        points = []
+        while lo < len(timestamps) and bucket_start < end:
+            hi = bisect_left(timestamps, bucket_start + step, lo)
+            if hi > lo:
+                chunk = values[lo:hi]
+                points.append({
+                    'timestamp': bucket_start,
+                    'min': min(chunk),
+                    'max': max(chunk),
+                    'avg': sum(chunk) / len(chunk),
+                    'samples': hi - lo
+                })
+            lo = hi
+            bucket_start += step
+        return points
+
+
+class MetricsSampler:
+    """Reads psutil once per interval in a background thread and keeps the latest sample.
+
+    Scrapes are served from the latest sample, so psutil cost does not grow with
+    the number of scrapers. The encoded Prometheus payload is cached until the
+    next sample replaces it.
+    """
+
+    def __init__(self, interval, retention):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.latest = None
+        self.prometheus_cache = None
+        self.thread = None
+        capacity = int(math.ceil(retention / interval)) + 1
+        self.history = MetricHistory(capacity, list(HISTORY_UNITS))
+        self.previous = None
+        self.rates = {'network': {}, 'disk': {}, 'container': {}}
+        self.cgroup = CgroupReader(CGROUP_PATH) if CgroupReader.enabled(CONTAINER_MODE, CGROUP_PATH) else None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        # Prime cpu_percent so the first real sample reports usage since now, not since boot
+        psutil.cpu_percent(percpu=True)
+        self.sample()
+        self.thread = threading.Thread(target=self.run, name='metrics-sampler', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sample()
+            except Exception as e:
+                app.logger.warning('metrics sample failed: %s', e)
+
+    def sample(self):
+        filesystems = {}
+        for part in psutil.disk_partitions(all=False):
+            if part.mountpoint in filesystems:
+                continue
+            try:
+                usage = psutil.disk_usage(part.mountpoint)
+            except OSError:
+                continue
+            filesystems[part.mountpoint] = {
+                'device': part.device,
+                'fstype': part.fstype,
+                'total': usage.total,
+                'used': usage.used,
+                'free': usage.free
+            }
+
+        snapshot = {
+            'timestamp': time.time(),
+            'cpu_percpu': psutil.cpu_percent(percpu=True),
+            'cpu_count': psutil.cpu_count(),
+            'memory': psutil.virtual_memory(),
+            'network': psutil.net_io_counters(pernic=True),
+            'disk_io': psutil.disk_io_counters(perdisk=True) or {},
+            'filesystems': filesystems,
+            'cgroup': self.cgroup.sample() if self.cgroup is not None else None
+        }
+        rates = self.compute_rates(snapshot)
+        root = psutil.disk_usage('/')
+        cpus = snapshot['cpu_percpu']
+        nic_rates = rates['network'].values()
+        with self.lock:
+            self.latest = snapshot
+            self.rates = rates
+            self.prometheus_cache = None
+            self.history.record(snapshot['timestamp'], {
+                'cpu': sum(cpus) / len(cpus),
+                'memory': snapshot['memory'].percent,
+                'disk': root.percent,
+                'network_sent': sum(r['bytes_sent_per_sec'] for r in nic_rates),
+                'network_recv': sum(r['bytes_recv_per_sec'] for r in nic_rates)
+            })
+
+    def compute_rates(self, snapshot):
+        # Rates need two samples of the same device, so an interface or disk that
+        # just appeared gets rates from the next sample on, and one that vanished
+        # simply drops out because only the current sample is remembered.
+        previous, self.previous = self.previous, snapshot
+        rates = {'network': {}, 'disk': {}, 'container': {}}
+        if previous is None:
+            return rates
+        elapsed = snapshot['timestamp'] - previous['timestamp']
+        if elapsed <= 0:
+            return rates
+
+        for nic, stats in snapshot['network'].items():
+            before = previous['network'].get(nic)
+            if before is None:
+                continue
+            rates['network'][nic] = {
+                f'{field}_per_sec': round(counter_delta(getattr(stats, field), getattr(before, field)) / elapsed, 2)
+                for field in ('bytes_sent', 'bytes_recv', 'packets_sent', 'packets_recv')
+            }
+
+        for disk, stats in snapshot['disk_io'].items():
+            before = previous['disk_io'].get(disk)
+            if before is None:
+                continue
+            reads = counter_delta(stats.read_count, before.read_count) / elapsed
+            writes = counter_delta(stats.write_count, before.write_count) / elapsed
+            disk_rates = {
+                'read_iops': round(reads, 2),
+                'write_iops': round(writes, 2),
+                'iops': round(reads + writes, 2),
+                'read_bytes_per_sec': round(counter_delta(stats.read_bytes, before.read_bytes) / elapsed, 2),
+                'write_bytes_per_sec': round(counter_delta(stats.write_bytes, before.write_bytes) / elapsed, 2),
+                'utilization_percent': None
+            }
+            # busy_time (ms spent doing I/O) is only reported on Linux and FreeBSD
+            if hasattr(stats, 'busy_time'):
+                busy_ms = counter_delta(stats.busy_time, before.busy_time)
+                disk_rates['utilization_percent'] = round(min(100.0, busy_ms / (elapsed * 1000) * 100), 2)
+            rates['disk'][disk] = disk_rates
+
+        if snapshot['cgroup'] is not None and previous['cgroup'] is not None:
+            rates['container'] = self.compute_container_rates(snapshot['cgroup'], previous['cgroup'], elapsed)
+        return rates
+
+    @staticmethod
+    def compute_container_rates(cgroup, before, elapsed):
+        cpu, cpu_before = cgroup['cpu_stat'], before['cpu_stat']
+        rates = {}
+        if 'usage_usec' in cpu and 'usage_usec' in cpu_before:
+            cores_used = counter_delta(cpu['usage_usec'], cpu_before['usage_usec']) / 1e6 / elapsed
+            limit = cgroup['cpu_limit_cores'] or psutil.cpu_count()
+            rates['cpu_cores_used'] = round(cores_used, 3)
+            rates['cpu_percent_of_limit'] = round(cores_used / limit * 100, 2)
+        if 'nr_periods' in cpu and 'nr_periods' in cpu_before:
+            periods = counter_delta(cpu['nr_periods'], cpu_before['nr_periods'])
+            throttled = counter_delta(cpu['nr_throttled'], cpu_before['nr_throttled'])
+            rates['throttled_percent'] = round(throttled / periods * 100, 2) if periods else 0.0
+            rates['throttled_seconds_per_sec'] = round(
+                counter_delta(cpu['throttled_usec'], cpu_before['throttled_usec']) / 1e6 / elapsed, 3)
+        rates['io'] = {}
+        for device, stats in cgroup['io'].items():
+            stats_before = before['io'].get(device)
+            if stats_before is None:
+                continue
+            rates['io'][device] = {
+                f'{field}_per_sec': round(counter_delta(stats.get(field, 0), stats_before.get(field, 0)) / elapsed, 2)
+                for field in ('rbytes', 'wbytes', 'rios', 'wios')
+            }
+        return rates
+
+    def current_rates(self):
+        with self.lock:
+            return self.rates
+
+    def current_cgroup(self):
+        with self.lock:
+            return self.latest['cgroup']
+
+    def query_history(self, name, window, step):
+        with self.lock:
+            timestamps, values = self.history.ordered(name)
+        end = time.time()
+        return MetricHistory.downsample(timestamps, values, end - window, end, step)
+
+    def prometheus(self):
+        with self.lock:
+            if self.prometheus_cache is None:
+                self.prometheus_cache = self.encode_prometheus(self.latest)
+            return self.prometheus_cache
+
+    @staticmethod
+    def encode_prometheus(snapshot):
+        lines = []
+        cpus = snapshot['cpu_percpu']
+        add_metric(lines, 'vm_cpu_usage_ratio', 'gauge',
+                   'CPU utilisation per logical CPU over the last sample interval (0-1).',
+                   [({'cpu': str(i)}, pct / 100) for i, pct in enumerate(cpus)])
+        add_metric(lines, 'vm_cpu_count', 'gauge', 'Number of logical CPUs.',
+                   [({}, snapshot['cpu_count'])])
+
+        mem = snapshot['memory']
+        add_metric(lines, 'vm_memory_total_bytes', 'gauge', 'Total physical memory in bytes.', [({}, mem.total)])
+        add_metric(lines, 'vm_memory_used_bytes', 'gauge', 'Used physical memory in bytes.', [({}, mem.used)])
+        add_metric(lines, 'vm_memory_free_bytes', 'gauge', 'Free physical memory in bytes.', [({}, mem.free)])
+        add_metric(lines, 'vm_memory_available_bytes', 'gauge',
+                   'Memory available to new processes in bytes.', [({}, mem.available)])
+
+        nics = snapshot['network']
+        for name, field, help_text in (
+                ('vm_network_transmit_bytes_total', 'bytes_sent', 'Bytes sent per interface.'),
+                ('vm_network_receive_bytes_total', 'bytes_recv', 'Bytes received per interface.'),
+                ('vm_network_transmit_packets_total', 'packets_sent', 'Packets sent per interface.'),
+                ('vm_network_receive_packets_total', 'packets_recv', 'Packets received per interface.'),
+                ('vm_network_transmit_errors_total', 'errout', 'Transmit errors per interface.'),
+                ('vm_network_receive_errors_total', 'errin', 'Receive errors per interface.'),
+                ('vm_network_transmit_drop_total', 'dropout', 'Outgoing packets dropped per interface.'),
+                ('vm_network_receive_drop_total', 'dropin', 'Incoming packets dropped per interface.')):
+            add_metric(lines, name, 'counter', help_text,
+                       [({'interface': nic}, getattr(stats, field)) for nic, stats in nics.items()])
+
+        filesystems = snapshot['filesystems']
+        for name, field, help_text in (
+                ('vm_filesystem_size_bytes', 'total', 'Filesystem size in bytes.'),
+                ('vm_filesystem_used_bytes', 'used', 'Filesystem space used in bytes.'),
+                ('vm_filesystem_free_bytes', 'free', 'Filesystem space free in bytes.')):
+            add_metric(lines, name, 'gauge', help_text,
+                       [({'mountpoint': mount, 'device': fs['device'], 'fstype': fs['fstype']}, fs[field])
+                        for mount, fs in filesystems.items()])
+
+        cgroup = snapshot['cgroup']
+        if cgroup is not None:
+            if cgroup['memory_usage'] is not None:
+                add_metric(lines, 'vm_container_memory_usage_bytes', 'gauge',
+                           'Memory charged to the container cgroup, including page cache.',
+                           [({}, cgroup['memory_usage'])])
+            if cgroup['memory_limit'] is not None:
+                add_metric(lines, 'vm_container_memory_limit_bytes', 'gauge',
+                           'Memory limit of the container cgroup.', [({}, cgroup['memory_limit'])])
+            if cgroup['cpu_limit_cores'] is not None:
+                add_metric(lines, 'vm_container_cpu_limit_cores', 'gauge',
+                           'CPU quota of the container cgroup in cores.', [({}, cgroup['cpu_limit_cores'])])
+            cpu = cgroup['cpu_stat']
+            for name, field, scale, help_text in (
+                    ('vm_container_cpu_usage_seconds_total', 'usage_usec', 1e6, 'CPU time used by the container.'),
+                    ('vm_container_cpu_periods_total', 'nr_periods', 1, 'CFS enforcement periods elapsed.'),
+                    ('vm_container_cpu_throttled_periods_total', 'nr_throttled', 1, 'CFS periods the container was throttled in.'),
+                    ('vm_container_cpu_throttled_seconds_total', 'throttled_usec', 1e6, 'Time the container was throttled.')):
+                if field in cpu:
+                    add_metric(lines, name, 'counter', help_text, [({}, cpu[field] / scale)])
+            pressure = cgroup['pressure']
+            add_metric(lines, 'vm_container_pressure_stalled_seconds_total', 'counter',
+                       'Time tasks in the container were stalled on a resource (PSI).',
+                       [({'resource': resource, 'kind': kind}, values['total'] / 1e6)
+                        for resource, kinds in pressure.items() for kind, values in kinds.items()])
+            for name, field, help_text in (
+                    ('vm_container_io_read_bytes_total', 'rbytes', 'Bytes read by the container per device.'),
+                    ('vm_container_io_written_bytes_total', 'wbytes', 'Bytes written by the container per device.'),
+                    ('vm_container_io_reads_total', 'rios', 'Read operations by the container per device.'),
+                    ('vm_container_io_writes_total', 'wios', 'Write operations by the container per device.')):
+                add_metric(lines, name, 'counter', help_text,
+                           [({'device': device}, stats.get(field, 0)) for device, stats in cgroup['io'].items()])
+
+        add_metric(lines, 'vm_sample_timestamp_seconds', 'gauge',
+                   'Unix time of the sample these values come from.', [({}, snapshot['timestamp'])])
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class ProcessSampler:
+    """Walks the process table once per interval and keeps a row per process.
+
+    CPU and I/O are computed from deltas against the previous pass, keyed by pid
+    and create_time so a recycled pid is not mistaken for the old process.
+    Exited pids fall out because only pids seen in the latest pass are kept.
+    """
+
+    def __init__(self, interval, cpu_budget):
+        self.interval = interval
+        self.cpu_budget = cpu_budget
+        self.lock = threading.Lock()
+        self.previous = {}
+        self.previous_time = None
+        self.rows = []
+        self.sampled_at = None
+        self.sample_cost = 0.0
+        self.effective_interval = interval
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name='process-sampler', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                app.logger.warning('process sample failed: %s', e)
+            time.sleep(self.effective_interval)
+
+    def sample(self):
+        cost_start = time.thread_time()
+        now = time.monotonic()
+        elapsed = now - self.previous_time if self.previous_time is not None else None
+        previous = self.previous
+        current = {}
+        rows = []
+        for proc in psutil.process_iter(attrs=PROCESS_ATTRS, ad_value=None):
+            info = proc.info
+            pid = info['pid']
+            cpu = info['cpu_times']
+            cpu_seconds = cpu.user + cpu.system if cpu is not None else None
+            io = info['io_counters']
+            io_bytes = io.read_bytes + io.write_bytes if io is not None else None
+            memory = info['memory_info']
+
+            cpu_percent = None
+            io_rate = None
+            before = previous.get(pid)
+            if elapsed and before is not None and before[0] == info['create_time']:
+                if cpu_seconds is not None and before[1] is not None:
+                    cpu_percent = round(max(0.0, cpu_seconds - before[1]) / elapsed * 100, 2)
+                if io_bytes is not None and before[2] is not None:
+                    io_rate = round(max(0, io_bytes - before[2]) / elapsed, 2)
+
+            current[pid] = (info['create_time'], cpu_seconds, io_bytes)
+            rows.append((pid, info['name'], cpu_percent,
+                         memory.rss if memory is not None else None, io_rate))
+
+        self.previous = current
+        self.previous_time = now
+        cost = time.thread_time() - cost_start
+        # Stretch the interval when a pass is expensive (e.g. thousands of processes)
+        self.effective_interval = max(self.interval, cost / self.cpu_budget)
+        with self.lock:
+            self.rows = rows
+            self.sampled_at = time.time()
+            self.sample_cost = cost
+
+    def top(self, count, sort_by):
+        index = PROCESS_SORT_KEYS[sort_by]
+        with self.lock:
+            rows = self.rows
+            summary = {
+                'sampled_at': self.sampled_at,
+                'process_count': len(rows),
+                'sample_cpu_seconds': round(self.sample_cost, 4),
+                'sample_interval_seconds': round(self.effective_interval, 2)
+            }
+        top_rows = heapq.nlargest(count, rows, key=lambda row: row[index] or 0)
+        summary['processes'] = [dict(zip(PROCESS_FIELDS, row)) for row in top_rows]
+        return summary
+
+
+sampler = MetricsSampler(SAMPLE_INTERVAL, HISTORY_RETENTION)
+sampler.start()
+
+process_sampler = ProcessSampler(PROCESS_SAMPLE_INTERVAL, PROCESS_CPU_BUDGET)
+process_sampler.start()
+
+# Helper function to get CPU usage, from the container cgroup when running in container mode
+def get_cpu_data():
+    if sampler.cgroup is None:
+        return {
+            'percent': f"{psutil.cpu_percent(interval=1)}%",
+            'count': psutil.cpu_count(),
+            'container': None
+        }
+    cgroup = sampler.current_cgroup()
+    rates = sampler.current_rates()['container']
+    return {
+        'percent': f"{rates.get('cpu_percent_of_limit', 0.0)}%",
+        'count': cgroup['cpu_limit_cores'] or psutil.cpu_count(),
+        'container': {
+            'cores_used': rates.get('cpu_cores_used'),
+            'throttled_percent': rates.get('throttled_percent'),
+            'pressure_some_avg10': cgroup['pressure'].get('cpu', {}).get('some', {}).get('avg10')
+        }
+    }
+
+# Helper function to get memory usage, from the container cgroup when running in container mode
+def get_memory_data():
+    memory_info = psutil.virtual_memory()
+    if sampler.cgroup is None:
+        return {
+            'total_MB': bytes_to_mb(memory_info.total),
+            'used_MB': bytes_to_mb(memory_info.used),
+            'free_MB': bytes_to_mb(memory_info.free),
+            'container': None
+        }
+    cgroup = sampler.current_cgroup()
+    limit = cgroup['memory_limit'] or memory_info.total
+    usage = cgroup['memory_usage'] or 0
+    # Working set (usage minus reclaimable file cache) is what the OOM killer compares to the limit
+    working_set = max(0, usage - cgroup['memory_stat'].get('inactive_file', 0))
+    return {
+        'total_MB': bytes_to_mb(limit),
+        'used_MB': bytes_to_mb(working_set),
+        'free_MB': bytes_to_mb(max(0, limit - working_set)),
+        'container': {
+            'limited': cgroup['memory_limit'] is not None,
+            'usage_MB': bytes_to_mb(usage),
+            'pressure_some_avg10': cgroup['pressure'].get('memory', {}).get('some', {}).get('avg10')
+        }
+    }
+
 @app.route('/metrics/cpu')
 def cpu_metrics():
-    cpu_percent = psutil.cpu_percent(interval=1)
-    cpu_count = psutil.cpu_count()
-    cpu_info = {
-        'percent': f"{cpu_percent}%",
-        'count': cpu_count
-    }
+    cpu_info = get_cpu_data()
+    if request.args.get('format') == 'json':
+        return jsonify(cpu_info)
     return render_template('cpu_metrics.html', cpu=cpu_info)
 
 @app.route('/metrics/memory')
 def memory_metrics():
-    memory_info = psutil.virtual_memory()
-    memory_data = {
-        'total_MB': bytes_to_mb(memory_info.total),
-        'used_MB': bytes_to_mb(memory_info.used),
-        'free_MB': bytes_to_mb(memory_info.free)
-    }
+    memory_data = get_memory_data()
+    if request.args.get('format') == 'json':
+        return jsonify(memory_data)
     return render_template('memory_metrics.html', memory=memory_data)
 
-@app.route('/metrics/disk')
-def disk_metrics():
-    disk_usage = psutil.disk_usage('/')
-    disk_data = {
-        'total_MB': bytes_to_mb(disk_usage.total),
-        'used_MB': bytes_to_mb(disk_usage.used),
-        'free_MB': bytes_to_mb(disk_usage.free)
-    }
-    return render_template('disk_metrics.html', disk=disk_data)
-
-@app.route('/metrics/network')
-def network_metrics():
+# Helper function to gather network totals and the sampler's per-interface rates
+def get_network_data():
     network_info = psutil.net_io_counters()
+    nic_rates = sampler.current_rates()['network']
     system_wide = {
         'bytes_sent_MB': bytes_to_mb(network_info.bytes_sent),
         'bytes_recv_MB': bytes_to_mb(network_info.bytes_recv),
         'packets_sent': network_info.packets_sent,
-        'packets_recv': network_info.packets_recv
+        'packets_recv': network_info.packets_recv,
+        'bytes_sent_per_sec': round(sum(r['bytes_sent_per_sec'] for r in nic_rates.values()), 2),
+        'bytes_recv_per_sec': round(sum(r['bytes_recv_per_sec'] for r in nic_rates.values()), 2),
+        'packets_sent_per_sec': round(sum(r['packets_sent_per_sec'] for r in nic_rates.values()), 2),
+        'packets_recv_per_sec': round(sum(r['packets_recv_per_sec'] for r in nic_rates.values()), 2)
     }
-    
-    net_per_interface = psutil.net_io_counters(pernic=True)
-    interface_stats = {
-        interface: {
+
+    interface_stats = {}
+    for interface, stats in psutil.net_io_counters(pernic=True).items():
+        interface_stats[interface] = {
             'bytes_sent_MB': bytes_to_mb(stats.bytes_sent),
             'bytes_recv_MB': bytes_to_mb(stats.bytes_recv),
             'packets_sent': stats.packets_sent,
-            'packets_recv': stats.packets_recv
-        } for interface, stats in net_per_interface.items()
-    }
-    
-    network_data = {
+            'packets_recv': stats.packets_recv,
+            # None until the sampler has seen the interface twice
+            'rates': nic_rates.get(interface)
+        }
+
+    return {
         'system_wide': system_wide,
         'per_interface': interface_stats
     }
+
+@app.route('/metrics/disk')
+def disk_metrics():
+    disk_usage = psutil.disk_usage('/')
+    disk_rates = sampler.current_rates()['disk']
+    per_disk = {}
+    for disk, stats in (psutil.disk_io_counters(perdisk=True) or {}).items():
+        per_disk[disk] = {
+            'read_count': stats.read_count,
+            'write_count': stats.write_count,
+            'read_MB': bytes_to_mb(stats.read_bytes),
+            'write_MB': bytes_to_mb(stats.write_bytes),
+            'rates': disk_rates.get(disk)
+        }
+    disk_data = {
+        'total_MB': bytes_to_mb(disk_usage.total),
+        'used_MB': bytes_to_mb(disk_usage.used),
+        'free_MB': bytes_to_mb(disk_usage.free),
+        'per_disk': per_disk,
+        # I/O of this container's cgroup by device (major:minor), None outside container mode
+        'container': sampler.current_rates()['container'].get('io', {}) if sampler.cgroup is not None else None
+    }
+    if request.args.get('format') == 'json':
+        return jsonify(disk_data)
+    return render_template('disk_metrics.html', disk=disk_data)
+
+@app.route('/metrics/network')
+def network_metrics():
+    network_data = get_network_data()
+    if request.args.get('format') == 'json':
+        return jsonify(network_data)
     return render_template('network_metrics.html', network=network_data)
 
+@app.route('/metrics/prometheus')
+def prometheus_metrics():
+    return Response(sampler.prometheus(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+@app.route('/metrics/history')
+def history_metrics():
+    metric = request.args.get('metric', 'cpu')
+    if metric not in sampler.history.series:
+        return jsonify({'error': f"Unknown metric '{metric}'",
+                        'metrics': sorted(sampler.history.series)}), 400
+    try:
+        window = parse_duration(request.args.get('window', '1h'))
+        step = parse_duration(request.args.get('step', f'{SAMPLE_INTERVAL}s'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if window / step > HISTORY_MAX_POINTS:
+        return jsonify({'error': f'window/step must not exceed {HISTORY_MAX_POINTS} points'}), 400
+
+    points = sampler.query_history(metric, window, step)
+    return jsonify({
+        'metric': metric,
+        'unit': HISTORY_UNITS[metric],
+        'window_seconds': window,
+        'step_seconds': step,
+        'points': points
+    })
+
+@app.route('/metrics/processes')
+def process_metrics():
+    sort_by = request.args.get('by', 'cpu')
+    if sort_by not in PROCESS_SORT_KEYS:
+        return jsonify({'error': f"'by' must be one of {', '.join(PROCESS_SORT_KEYS)}"}), 400
+    try:
+        count = int(request.args.get('top', 20))
+    except ValueError:
+        return jsonify({'error': "'top' must be an integer"}), 400
+    if not 1 <= count <= 500:
+        return jsonify({'error': "'top' must be between 1 and 500"}), 400
+
+    process_data = process_sampler.top(count, sort_by)
+    process_data['sorted_by'] = sort_by
+    if request.args.get('format') == 'json':
+        return jsonify(process_data)
+    return render_template('processes.html', processes=process_data)
+
 @app.route('/metrics')
 def all_metrics():
-    cpu_percent = psutil.cpu_percent(interval=1)
-    cpu_count = psutil.cpu_count()
-    
-    memory_info = psutil.virtual_memory()
-    memory_data = {
-        'total_MB': bytes_to_mb(memory_info.total),
-        'used_MB': bytes_to_mb(memory_info.used),
-        'free_MB': bytes_to_mb(memory_info.free)
-    }
+    cpu_data = get_cpu_data()
+    memory_data = get_memory_data()
     
     disk_usage = psutil.disk_usage('/')
     disk_data = {
@@ -82,30 +766,16 @@ def all_metrics():
         'free_MB': bytes_to_mb(disk_usage.free)
     }
     
-    network_info = psutil.net_io_counters()
-    network_data = {
-        'system_wide': {
-            'bytes_sent_MB': bytes_to_mb(network_info.bytes_sent),
-            'bytes_recv_MB': bytes_to_mb(network_info.bytes_recv),
-            'packets_sent': network_info.packets_sent,
-            'packets_recv': network_info.packets_recv
-        },
-        'per_interface': {
-            interface: {
-                'bytes_sent_MB': bytes_to_mb(stats.bytes_sent),
-                'bytes_recv_MB': bytes_to_mb(stats.bytes_recv),
-                'packets_sent': stats.packets_sent,
-                'packets_recv': stats.packets_recv
-            } for interface, stats in psutil.net_io_counters(pernic=True).items()
-        }
-    }
+    network_data = get_network_data()
     
     metrics = {
-        'cpu': {'percent': f"{cpu_percent}%", 'count': cpu_count},
+        'cpu': cpu_data,
         'memory': memory_data,
         'disk': disk_data,
         'network': network_data
     }
+    if request.args.get('format') == 'json':
+        return jsonify(metrics)
     return render_template('metrics.html', metrics=metrics)
 
 if __name__ == '__main__':